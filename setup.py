@@ -34,7 +34,7 @@ setup(
     xml_update = presence_analyzer.script:xml_update_data
 
     [paste.app_factory]
-    main = presence_analyzer.script:make_app
+    main = presence_analyzer.script:make_deploy
     debug = presence_analyzer.script:make_debug
     """,
 )
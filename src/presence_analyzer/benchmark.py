@@ -0,0 +1,503 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the application.
+"""
+
+import bz2
+import datetime
+import gzip
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import threading
+import urllib2
+from bisect import bisect_right
+from contextlib import closing
+from timeit import default_timer
+from time import time
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import utils
+import xmldata
+
+FIRST_NAMES = (
+    'Adam', 'Agata', 'Anna', 'Bartosz', 'Ewa', 'Jan', 'Kamil', 'Maria',
+    'Marta', 'Piotr', 'Tomasz', 'Zofia',
+)
+# file extension: open function of compressed copies of benchmarked CSV
+COMPRESSED = (
+    ('.gz', gzip.open),
+    ('.bz2', bz2.BZ2File),
+)
+# path: weight, {user_id} is replaced by random user
+LOAD_TEST_MIX = (
+    ('/api/v1/users', 1),
+    ('/api/v2/users', 1),
+    ('/api/v2/mean_time_weekday/{user_id}', 4),
+    ('/api/v2/presence_weekday/{user_id}', 4),
+    ('/api/v2/presence_start_end/{user_id}', 4),
+    ('/api/v2/weekday_stats?user_ids={user_id}', 2),
+    ('/api/v2/weekday_stats', 1),
+)
+
+
+def contention(app, urls, threads=8, requests=1000):
+    """
+    Requests urls from many threads at once through Flask test client.
+
+    Every thread requests all urls in turn until it made given number of
+    requests. Returns dict with number of threads, requests, failed
+    (non-200) responses, seconds taken and requests per second.
+    """
+    start = threading.Event()
+    failed = []
+
+    def hammer():
+        """
+        Makes requests of a single thread.
+        """
+        client = app.test_client()
+        start.wait()
+        for i in xrange(requests):
+            response = client.get(urls[i % len(urls)])
+            if response.status_code != 200:
+                failed.append(response.status_code)
+
+    workers = [threading.Thread(target=hammer) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    started = time()
+    start.set()
+    for worker in workers:
+        worker.join()
+    seconds = time() - started
+    return {
+        'threads': threads,
+        'requests': threads * requests,
+        'failed': len(failed),
+        'seconds': seconds,
+        'throughput': threads * requests / seconds,
+    }
+
+
+def generate_presence(path, users, days, seed=0,
+                      first_day=datetime.date(2013, 1, 2)):
+    """
+    Writes synthetic presence CSV file of given users and calendar days.
+
+    Users have ids from 10 on and come to work on most working days,
+    rows are sorted by user and date like in real data. The same seed
+    always gives the same file.
+    """
+    generator = random.Random(seed)
+    dates = [
+        (first_day + datetime.timedelta(days=day)).isoformat()
+        for day in xrange(days)
+        if (first_day + datetime.timedelta(days=day)).weekday() < 5
+    ]
+    with open(path, 'w') as csvfile:
+        for user_id in xrange(10, 10 + users):
+            arrival = generator.gauss(8.5 * 3600, 1800)
+            rows = []
+            for date in dates:
+                if generator.random() < 0.1:
+                    continue
+                start = int(min(max(generator.gauss(arrival, 1200), 0), 43200))
+                end = int(min(start + generator.gauss(8 * 3600, 3600), 86399))
+                rows.append('{},{},{},{}\n'.format(
+                    user_id, date, clock(start), clock(max(end, start))
+                ))
+            csvfile.writelines(rows)
+
+
+def generate_users(path, users, seed=0):
+    """
+    Writes synthetic users XML file matching generate_presence.
+    """
+    generator = random.Random(seed)
+    with open(path, 'w') as xmlfile:
+        xmlfile.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n<intranet>\n'
+            '    <server>\n'
+            '        <host>intranet.stxnext.pl</host>\n'
+            '        <port>443</port>\n'
+            '        <protocol>https</protocol>\n'
+            '    </server>\n    <users>\n'
+        )
+        for user_id in xrange(10, 10 + users):
+            xmlfile.write(
+                '        <user id="{0}">\n'
+                '            <avatar>/api/images/users/{0}</avatar>\n'
+                '            <name>{1} {2}.</name>\n'
+                '        </user>\n'.format(
+                    user_id,
+                    generator.choice(FIRST_NAMES),
+                    chr(generator.randint(ord('A'), ord('Z'))),
+                )
+            )
+        xmlfile.write('    </users>\n</intranet>\n')
+
+
+def clock(seconds):
+    """
+    Formats seconds since midnight as HH:MM:SS.
+    """
+    return '{:02}:{:02}:{:02}'.format(
+        seconds // 3600, seconds // 60 % 60, seconds % 60
+    )
+
+
+def measure(function, repeat):
+    """
+    Calls function given number of times and returns timings in seconds.
+    """
+    timings = []
+    for i in xrange(repeat):
+        started = default_timer()
+        function()
+        timings.append(default_timer() - started)
+    return {
+        'repeat': repeat,
+        'best': min(timings),
+        'mean': sum(timings) / repeat,
+    }
+
+
+def benchmarks(app, csv_path, xml_path):
+    """
+    Returns (name, function) pairs of benchmarked utilities and views.
+
+    Functions with "cold" in name drop loaded data and load it again,
+    others work on loaded data. Utilities are run over all users.
+    """
+    def cold_get_data():
+        """
+        Loads presence data from scratch.
+        """
+        utils.CACHE.pop('load_source', None)
+        utils.SOURCES.pop(csv_path, None)
+        utils.get_data()
+
+    def cold_load_presence(path):
+        """
+        Returns function parsing given presence file from scratch.
+        """
+        def load():
+            utils.SOURCES.pop(path, None)
+            utils.load_presence(path)
+        return load
+
+    def cold_xml_data_parser():
+        """
+        Parses users from scratch.
+        """
+        xmldata.USERS.pop(xml_path, None)
+        xmldata.xml_data_parser()
+
+    def over_users(function):
+        """
+        Returns function calling given one with every user's entries.
+        """
+        return lambda: [function(items) for items in utils.get_data().values()]
+
+    def request(url):
+        """
+        Returns function requesting url from the application.
+        """
+        client = app.test_client()
+        return lambda: client.get(url).data
+
+    user_id = min(utils.get_weekday_index())
+    weekdays = [
+        utils.group_by_weekday(items) for items in utils.get_data().values()
+    ]
+    return [
+        ('get_data cold', cold_get_data),
+        ('get_data', utils.get_data),
+        ('get_weekday_index', utils.get_weekday_index),
+        ('get_store', utils.get_store),
+        ('load_presence', cold_load_presence(csv_path)),
+        ('load_presence gzip', cold_load_presence(csv_path + '.gz')),
+        ('load_presence bzip2', cold_load_presence(csv_path + '.bz2')),
+        ('xml_data_parser cold', cold_xml_data_parser),
+        ('group_by_weekday', over_users(utils.group_by_weekday)),
+        ('group_by_start_end', over_users(utils.group_by_start_end)),
+        ('mean', lambda: [
+            [utils.mean(intervals) for intervals in week] for week in weekdays
+        ]),
+        ('/api/v1/users', request('/api/v1/users')),
+        ('/api/v2/users', request('/api/v2/users')),
+        ('/api/v2/mean_time_weekday', request(
+            '/api/v2/mean_time_weekday/{}'.format(user_id)
+        )),
+        ('/api/v2/presence_weekday', request(
+            '/api/v2/presence_weekday/{}'.format(user_id)
+        )),
+        ('/api/v2/presence_start_end', request(
+            '/api/v2/presence_start_end/{}'.format(user_id)
+        )),
+        ('/api/v2/weekday_stats', request('/api/v2/weekday_stats')),
+    ]
+
+
+def run(app, directory, users=100, days=365, seed=0, repeat=3):
+    """
+    Times utilities and views on synthetic data of given size.
+
+    Data files are generated in directory and reused by later runs with
+    the same parameters. Returns machine-readable results, which can be
+    stored as JSON and compared with compare.
+    """
+    # pylint: disable=too-many-arguments
+    name = os.path.join(
+        directory, 'presence-{}-{}-{}'.format(users, days, seed)
+    )
+    if not os.path.exists(name + '.csv'):
+        generate_presence(name + '.csv.tmp', users, days, seed)
+        os.rename(name + '.csv.tmp', name + '.csv')
+    for extension, open_compressed in COMPRESSED:
+        if not os.path.exists(name + '.csv' + extension):
+            compress(name + '.csv', extension, open_compressed)
+    if not os.path.exists(name + '.xml'):
+        generate_users(name + '.xml', users, seed)
+    config = app.config.copy()
+    app.config.update(
+        DATA_CSV=name + '.csv',
+        XML_DATA=name + '.xml',
+        DATA_SHARED=False,
+        DATA_SNAPSHOT=False,
+    )
+    try:
+        results = {
+            benchmark: measure(function, repeat)
+            for benchmark, function in benchmarks(
+                app, name + '.csv', name + '.xml'
+            )
+        }
+        rows = len(utils.get_store())
+    finally:
+        app.config.clear()
+        app.config.update(config)
+        utils.CACHE.pop('load_source', None)
+        for extension in ('',) + zip(*COMPRESSED)[0]:
+            utils.SOURCES.pop(name + '.csv' + extension, None)
+        xmldata.USERS.pop(name + '.xml', None)
+    return {
+        'parameters': {
+            'users': users,
+            'days': days,
+            'seed': seed,
+            'rows': rows,
+        },
+        'python': sys.version,
+        'time': time(),
+        'results': results,
+    }
+
+
+def compress(path, extension, open_compressed):
+    """
+    Writes compressed copy of file next to it.
+    """
+    with open(path, 'rb') as source:
+        with closing(open_compressed(path + '.tmp', 'wb')) as target:
+            shutil.copyfileobj(source, target)
+    os.rename(path + '.tmp', path + extension)
+
+
+def compare(baseline, current):
+    """
+    Returns (name, baseline seconds, current seconds, ratio) of results
+    present in both runs, comparing the best timings.
+    """
+    return [
+        (
+            name,
+            baseline['results'][name]['best'],
+            result['best'],
+            result['best'] / baseline['results'][name]['best'],
+        )
+        for name, result in sorted(current['results'].iteritems())
+        if name in baseline['results']
+    ]
+
+
+def save(path, results):
+    """
+    Writes results of run as JSON file.
+    """
+    with open(path, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+
+
+def load_test(url, mix=LOAD_TEST_MIX, threads=16, duration=10, seed=0,
+              reloader=None, reload_after=None):
+    """
+    Requests weighted mix of paths of running application over HTTP.
+
+    Every thread picks paths of mix at random by their weight until
+    duration in seconds passes. When reloader function is given, it is
+    called reload_after seconds after start and latencies of requests
+    made while it was running are reported on their own.
+
+    Returns dict with throughput and latency percentiles in seconds per
+    path, see latencies.
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    with closing(urllib2.urlopen(url + '/api/v1/users')) as response:
+        user_ids = [user['user_id'] for user in json.load(response)]
+    paths = [path for path, weight in mix]
+    bounds = []  # cumulative weights of paths
+    for _, weight in mix:
+        bounds.append((bounds[-1] if bounds else 0) + weight)
+    samples = []  # (path, started, seconds, succeeded)
+    reloading = {}
+
+    def client(number):
+        """
+        Makes requests of a single thread.
+        """
+        generator = random.Random(seed + number)
+        while default_timer() < deadline:
+            path = paths[
+                bisect_right(bounds, generator.random() * bounds[-1])
+            ]
+            started = default_timer()
+            try:
+                with closing(urllib2.urlopen(url + path.format(
+                        user_id=generator.choice(user_ids)))) as response:
+                    response.read()
+                succeeded = True
+            except (urllib2.URLError, IOError):
+                succeeded = False
+            samples.append(
+                (path, started, default_timer() - started, succeeded)
+            )
+
+    def reload_later():
+        """
+        Calls reloader function at its time.
+        """
+        threading.Event().wait(reload_after)
+        reloading['start'] = default_timer()
+        reloader()
+        reloading['end'] = default_timer()
+
+    workers = [
+        threading.Thread(target=client, args=(number,))
+        for number in range(threads)
+    ]
+    if reloader is not None:
+        workers.append(threading.Thread(target=reload_later))
+    started = default_timer()
+    deadline = started + duration
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    result = latencies(samples, default_timer() - started)
+    result['threads'] = threads
+    if reloading:
+        result['reload'] = latencies(
+            [
+                sample for sample in samples
+                if sample[1] < reloading['end'] and
+                sample[1] + sample[2] > reloading['start']
+            ],
+            reloading['end'] - reloading['start'],
+        )
+    return result
+
+
+def latencies(samples, seconds):
+    """
+    Summarizes samples of load_test made in given number of seconds.
+
+    Returns dict with overall number of requests, failed ones and
+    throughput, and the same plus 50th, 95th and 99th latency percentile
+    per path.
+    """
+    paths = {}
+    for path, _, latency, succeeded in samples:
+        paths.setdefault(path, []).append((latency, succeeded))
+    result = summary([sample[2:] for sample in samples], seconds)
+    result['paths'] = {
+        path: dict(
+            summary(path_samples, seconds),
+            p50=percentile(path_samples, 0.5),
+            p95=percentile(path_samples, 0.95),
+            p99=percentile(path_samples, 0.99),
+        )
+        for path, path_samples in paths.iteritems()
+    }
+    return result
+
+
+def summary(samples, seconds):
+    """
+    Returns number of (latency, succeeded) samples, failed ones and
+    throughput in requests per second.
+    """
+    return {
+        'seconds': seconds,
+        'requests': len(samples),
+        'failed': sum(1 for latency, succeeded in samples if not succeeded),
+        'throughput': len(samples) / seconds if seconds else 0,
+    }
+
+
+def percentile(samples, fraction):
+    """
+    Returns latency percentile of (latency, succeeded) samples using the
+    nearest rank method.
+    """
+    ordered = sorted(latency for latency, succeeded in samples)
+    return ordered[max(int(math.ceil(fraction * len(ordered))) - 1, 0)]
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    """
+    Request handler not logging every request.
+    """
+
+    def log_request(self, *args, **kwargs):
+        """
+        Skips logging of the request.
+        """
+
+
+def serve(app, host='127.0.0.1', port=0):
+    """
+    Serves application from a background thread for load_test.
+
+    Returns the server and its URL, server.shutdown stops it.
+    """
+    server = make_server(
+        host, port, app, threaded=True, request_handler=QuietRequestHandler
+    )
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://{}:{}'.format(host, server.server_port)
+
+
+def reload_data(app):
+    """
+    Loads presence data of application from scratch in place of loaded
+    data, like after the CSV file was replaced.
+
+    Snapshot of the file is removed first, otherwise it would be loaded
+    instead of parsing the file. A new one is saved by the reload, as
+    after replacing the file.
+    """
+    path = app.config['DATA_CSV']
+    snapshot = utils.snapshot_path(path)
+    if os.path.exists(snapshot):
+        os.remove(snapshot)
+    utils.SOURCES.pop(path, None)
+    utils.load_source.refresh()
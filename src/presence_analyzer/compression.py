@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming decompression of compressed presence CSV files.
+"""
+
+import bz2
+import subprocess
+import zlib
+from cStringIO import StringIO
+
+# bytes of compressed file read at once
+CHUNK_SIZE = 64 * 1024
+# (name, file extension, magic bytes) of supported compressions
+FORMATS = (
+    ('gzip', '.gz', '\x1f\x8b'),
+    ('bzip2', '.bz2', 'BZh'),
+    ('xz', '.xz', '\xfd7zXZ\x00'),
+)
+EXTENSIONS = tuple(extension for name, extension, magic in FORMATS)
+HEAD_SIZE = max(len(magic) for name, extension, magic in FORMATS)
+
+
+def detect(csvfile, path):
+    """
+    Returns name of compression of open file or None for plain one.
+
+    Compression is recognized by extension of path or, without known
+    extension, by magic bytes at the current position of file.
+    """
+    for name, extension, magic in FORMATS:
+        if path.endswith(extension):
+            return name
+    position = csvfile.tell()
+    head = csvfile.read(HEAD_SIZE)
+    csvfile.seek(position)
+    for name, extension, magic in FORMATS:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def decompressed(csvfile, compression):
+    """
+    Returns file-like object reading decompressed content of open file.
+
+    Plain file (compression None) is returned as is.
+    """
+    if compression is None:
+        return csvfile
+    return DecompressedFile(DECOMPRESSORS[compression](csvfile))
+
+
+class DecompressedFile(object):
+    """
+    Decompressed stream with readlines used by parse_presence.
+
+    Nothing is written to disk, only the decompressed chunks needed for
+    the requested lines and the incomplete last line are kept in memory.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.rest = ''
+
+    def readlines(self, sizehint=0):
+        """
+        Returns whole lines of at least sizehint bytes when available,
+        all remaining lines without sizehint.
+        """
+        parts = [self.rest]
+        size = len(self.rest)
+        for chunk in self.chunks:
+            parts.append(chunk)
+            size += len(chunk)
+            if 0 < sizehint <= size and '\n' in chunk:
+                break
+        else:
+            self.rest = ''
+            return StringIO(''.join(parts)).readlines()
+        data = ''.join(parts)
+        end = data.rfind('\n') + 1
+        self.rest = data[end:]
+        return StringIO(data[:end]).readlines()
+
+
+def decompress(csvfile, decompressor):
+    """
+    Yields decompressed content of file read in chunks.
+
+    Concatenated streams, like parts of file appended with `cat`, are
+    decompressed one after another.
+    """
+    current = decompressor()
+    for chunk in iter(lambda: csvfile.read(CHUNK_SIZE), ''):
+        while chunk:
+            try:
+                yield current.decompress(chunk)
+            except EOFError:
+                # bz2 stream ended right at the end of previous chunk
+                current = decompressor()
+                continue
+            chunk = current.unused_data
+            if chunk:
+                current = decompressor()
+
+
+def gunzip(csvfile):
+    """
+    Yields decompressed content of gzip file.
+    """
+    # window bits above 16 expect gzip header and trailer
+    return decompress(
+        csvfile, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+    )
+
+
+def bunzip2(csvfile):
+    """
+    Yields decompressed content of bzip2 file.
+    """
+    return decompress(csvfile, bz2.BZ2Decompressor)
+
+
+def unxz(csvfile):
+    """
+    Yields decompressed content of xz file.
+
+    Python 2 has no lzma module, so the file is piped through xz tool
+    reading directly from file descriptor of csvfile.
+    """
+    process = subprocess.Popen(
+        ['xz', '--decompress', '--stdout'],
+        stdin=csvfile, stdout=subprocess.PIPE,
+    )
+    try:
+        for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), ''):
+            yield chunk
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        if process.wait() > 0:
+            raise IOError('Cannot decompress xz file {}'.format(csvfile.name))
+
+
+DECOMPRESSORS = {
+    'gzip': gunzip,
+    'bzip2': bunzip2,
+    'xz': unxz,
+}
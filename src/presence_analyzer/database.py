@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite storage of presence data.
+"""
+
+import datetime
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from store import DAY, running_sums, weekday
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS presence (
+    user_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS source (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    metadata TEXT NOT NULL
+);
+"""
+# covering index of queries of all users, see PresenceDatabase.index
+DAY_INDEX = (
+    'CREATE INDEX IF NOT EXISTS presence_day '
+    'ON presence (day, start_time, end_time)'
+)
+# rows are grouped by day or by weekday of day ordinal, both are
+# identified by their first day, whose weekday is the weekday of group
+AGGREGATES_QUERY = (
+    'SELECT MIN(day), COUNT(*), SUM(end_time - start_time), '
+    'SUM(start_time), SUM(end_time) FROM presence '
+    'WHERE day BETWEEN ? AND ? {} GROUP BY {}'
+)
+BY_WEEKDAY = '(day - 1) % 7'
+LAST_DAY = datetime.date.max.toordinal()
+# user ids bound in a single query, SQLite allows 999 parameters at least
+USER_IDS_LIMIT = 500
+
+
+class PresenceDatabase(object):
+
+    """
+    Presence entries imported to SQLite database file.
+
+    Entries are kept in presence table clustered by (user_id, day)
+    primary key, so entries of a single user are read with one index
+    range scan. Queries of all users scan covering index ordered by day
+    instead and their aggregates are computed by SQL per day, so rows
+    are not sorted, and summed by weekday here:
+
+    presence: user_id, day (date.toordinal()), start_time, end_time
+    users: user_id of every user with entries
+    source: JSON metadata of imported CSV file
+
+    Database is in WAL mode, so readers are not blocked by import.
+    Every thread uses its own connection.
+    """
+
+    def __init__(self, path):
+        """
+        Opens database file, it is created on the first connection.
+        """
+        self.path = path
+        self.local = threading.local()
+
+    def connection(self):
+        """
+        Returns connection of current thread in autocommit mode.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=60, isolation_level=None
+            )
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SCHEMA)
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs block in transaction holding the write lock of database.
+
+        Other writers, also in other processes, wait for its end, readers
+        see the database as before the transaction until it is committed.
+        """
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def read_metadata(self):
+        """
+        Returns metadata written by write_metadata or None.
+        """
+        row = self.connection().execute(
+            'SELECT metadata FROM source WHERE id = 1'
+        ).fetchone()
+        return row and json.loads(row[0])
+
+    def write_metadata(self, metadata):
+        """
+        Stores JSON serializable metadata of imported data.
+        """
+        self.connection().execute(
+            'INSERT OR REPLACE INTO source VALUES (1, ?)',
+            (json.dumps(metadata),)
+        )
+
+    def clear(self):
+        """
+        Removes all entries and metadata.
+
+        Index by day is dropped too, since creating it once after rows are
+        inserted is faster than updating it on every insert.
+        """
+        connection = self.connection()
+        connection.execute('DROP INDEX IF EXISTS presence_day')
+        for table in ('presence', 'users', 'source'):
+            connection.execute('DELETE FROM ' + table)
+
+    def index(self):
+        """
+        Creates index by day, unless it exists already.
+        """
+        self.connection().execute(DAY_INDEX)
+
+    def insert(self, rows):
+        """
+        Inserts (user_id, day, start, end) rows, replacing entries of the
+        same user and day.
+        """
+        connection = self.connection()
+        connection.executemany(
+            'INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?)', rows
+        )
+        connection.executemany(
+            'INSERT OR IGNORE INTO users VALUES (?)',
+            [(user_id,) for user_id in set(row[0] for row in rows)]
+        )
+
+    def __len__(self):
+        return self.connection().execute(
+            'SELECT COUNT(*) FROM presence'
+        ).fetchone()[0]
+
+    def __contains__(self, user_id):
+        return self.connection().execute(
+            'SELECT 1 FROM users WHERE user_id = ?', (user_id,)
+        ).fetchone() is not None
+
+    def user_ids(self):
+        """
+        Returns sorted ids of users with entries.
+        """
+        return [
+            user_id for user_id, in self.connection().execute(
+                'SELECT user_id FROM users ORDER BY user_id'
+            )
+        ]
+
+    def weekday_aggregates(self, user_id, first=None, last=None):
+        """
+        Returns weekday aggregates of given user like the weekday index,
+        limited to days from first to last ordinal (inclusive).
+        """
+        return self.aggregates(
+            'AND user_id = ?', days(first, last) + (user_id,), BY_WEEKDAY
+        )
+
+    def group_aggregates(self, user_ids=None, first=None, last=None):
+        """
+        Returns tuple (users, aggregates) of given users together, of all
+        users when user_ids is None, limited to days from first to last
+        ordinal. Users is the number of users found, unknown are skipped.
+        """
+        if user_ids is None:
+            users = self.connection().execute(
+                'SELECT COUNT(*) FROM users'
+            ).fetchone()[0]
+            return users, self.aggregates('', days(first, last), 'day')
+        user_ids = [user_id for user_id in user_ids if user_id in self]
+        totals = [
+            {'count': 0, 'total': 0, 'start': 0, 'end': 0} for i in range(7)
+        ]
+        for begin in range(0, len(user_ids), USER_IDS_LIMIT):
+            batch = user_ids[begin:begin + USER_IDS_LIMIT]
+            for total, aggregates in zip(totals, self.aggregates(
+                    'AND user_id IN ({})'.format(', '.join('?' * len(batch))),
+                    days(first, last) + tuple(batch), BY_WEEKDAY)):
+                for name in aggregates:
+                    total[name] += aggregates[name]
+        return len(user_ids), totals
+
+    def aggregates(self, condition, parameters, group):
+        """
+        Returns weekday aggregates of entries matching AGGREGATES_QUERY
+        with given additional condition, grouped by given expression.
+        """
+        result = [
+            {'count': 0, 'total': 0, 'start': 0, 'end': 0} for i in range(7)
+        ]
+        for day, count, total, start, end in self.connection().execute(
+                AGGREGATES_QUERY.format(condition, group), parameters):
+            aggregates = result[weekday(day)]
+            aggregates['count'] += count
+            aggregates['total'] += total
+            aggregates['start'] += start
+            aggregates['end'] += end
+        return result
+
+    def occupancy(self, slot, first=None, last=None):
+        """
+        Returns number of users present in every slot of given width in
+        seconds by weekday, limited to days from first to last ordinal.
+
+        Returns the same (days, occupancy) tuple as PresenceStore.occupancy.
+        Its difference array is filled with numbers of rows grouped by day
+        and first slot or slot after the last one by SQL.
+        """
+        slots = -(-DAY // slot)
+        differences = [[0] * (slots + 1) for i in range(7)]
+        weekday_days = [set() for i in range(7)]
+        connection = self.connection()
+        for position, sign in [('start_time / ?', 1),
+                               ('(end_time + ? - 1) / ?', -1)]:
+            for day, slot_number, count in connection.execute(
+                    'SELECT day, ' + position + ', COUNT(*) FROM presence '
+                    'WHERE day BETWEEN ? AND ? AND end_time > start_time '
+                    'GROUP BY 1, 2',
+                    (slot,) * position.count('?') + days(first, last)):
+                differences[weekday(day)][slot_number] += sign * count
+                weekday_days[weekday(day)].add(day)
+        return (
+            [len(days_of_weekday) for days_of_weekday in weekday_days],
+            running_sums(differences),
+        )
+
+
+def days(first, last):
+    """
+    Returns parameters of day range from first to last ordinal, which
+    are unbounded when None.
+    """
+    return (
+        0 if first is None else first,
+        LAST_DAY if last is None else last,
+    )
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+Writing of data files read by other threads and processes.
+"""
+
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(path):
+    """
+    Opens temporary file next to path for writing in binary mode.
+
+    The file is renamed over path when the block finishes, so readers
+    never see it partial. It is removed when the block fails.
+    """
+    descriptor, temporary = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=os.path.basename(path)
+    )
+    try:
+        with os.fdopen(descriptor, 'wb') as output:
+            yield output
+        os.chmod(temporary, 0o644)
+        os.rename(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
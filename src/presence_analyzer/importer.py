@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Import of presence CSV files to SQLite database.
+"""
+
+import os
+from binascii import hexlify, unhexlify
+from timeit import default_timer
+
+import compression
+import metrics
+from database import PresenceDatabase
+from main import app
+from parsing import (
+    appended_offset,
+    count_rows,
+    parse_chunks,
+    parse_day,
+    parse_seconds,
+    parsed_end,
+)
+
+
+DATABASES = {}  # DATA_CSV: database it is imported to, see import_presence
+
+
+def import_presence(path):
+    """
+    Imports presence CSV file to SQLite database next to it (path with
+    .sqlite suffix).
+
+    Like in utils.load_presence only bytes appended since the previous
+    import are parsed and their rows inserted, replacing rows of the same
+    user and day, other changes import the file from scratch. Rows are
+    parsed and inserted chunk by chunk, so memory use does not grow with
+    size of the file. Import runs in one transaction, other processes wait
+    for it and then find the file imported already.
+
+    Returns source dict with 'database' key and identity of imported
+    version of the file.
+    """
+    # pylint: disable=too-many-locals
+    database = DATABASES.get(path)
+    if database is None:
+        database = DATABASES[path] = PresenceDatabase(path + '.sqlite')
+    stat = os.stat(path)
+    with database.transaction():
+        previous = database.read_metadata()
+        if previous is not None:
+            previous.update(
+                inode=tuple(previous['inode']),
+                tail=unhexlify(previous['tail']),
+                database=database,
+            )
+        with open(path, 'rb') as csvfile:
+            compressed = compression.detect(csvfile, path)
+            offset = appended_offset(csvfile, compressed, stat, previous)
+            if offset is None:
+                return previous
+            if not offset:
+                database.clear()
+            csvfile.seek(offset)
+            started = default_timer()
+            imported = malformed = 0
+            for rows, skipped in parse_chunks(
+                    compression.decompressed(csvfile, compressed),
+                    app.config['CSV_CHUNK_SIZE'], parse_day, parse_seconds):
+                database.insert(rows)
+                imported += len(rows)
+                malformed += skipped
+            database.index()
+            metrics.observe(
+                'presence_parse_seconds', default_timer() - started,
+                mode='append' if offset else 'full'
+            )
+            size, offset, tail = parsed_end(csvfile, compressed, stat, offset)
+        source = {
+            'inode': (stat.st_dev, stat.st_ino),
+            'size': size,
+            'mtime': stat.st_mtime,
+            'offset': offset,
+            'tail': tail,
+        }
+        database.write_metadata(dict(source, tail=hexlify(tail)))
+    count_rows(imported, malformed, path)
+    source['database'] = database
+    return source
@@ -9,3 +9,28 @@ from flask.ext.mako import MakoTemplates
 app = Flask(__name__)  # pylint: disable=invalid-name
 mako = MakoTemplates(app)
 
+# Defaults, overridden by deploy.cfg / debug.cfg in script.make_app
+app.config.update(
+    # function name: {'time': seconds, 'size': results}, see utils.cache
+    CACHE_CONFIG={},
+    CSV_CHUNK_SIZE=1024 * 1024,
+    # "memory" or "sqlite" (DATA_CSV imported to DATA_CSV.sqlite file)
+    DATA_ENGINE='memory',
+    # seconds between background refreshes, 0 disables, see scheduler
+    DATA_REFRESH_INTERVAL=60,
+    # users loaded one by one, see utils.load_user
+    DATA_LAZY=False,
+    DATA_SHARED=False,
+    DATA_SNAPSHOT=False,
+    # bytes appended since the last snapshot above which it is rewritten
+    DATA_SNAPSHOT_THRESHOLD=16 * 1024 * 1024,
+    JSON_CHUNK_SIZE=64 * 1024,
+    # fraction of requests profiled into PROFILE_DIR (var/log), see profiling
+    PROFILE_DIR=None,
+    PROFILE_RATE=0,
+    # processes parsing shards of DATA_CSV, 0 is one per CPU core
+    SHARD_PROCESSES=0,
+    UPDATE_XML_CHUNK_SIZE=64 * 1024,
+    UPDATE_XML_TIMEOUT=60,
+    XML_REFRESH_INTERVAL=60 * 60,
+)
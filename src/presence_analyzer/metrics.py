@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and histograms of the application in Prometheus text format.
+"""
+
+import threading
+from bisect import bisect_left
+
+LOCK = threading.Lock()
+COUNTERS = {}  # (name, labels): value counted by exited threads
+THREAD_COUNTERS = {}  # thread: its own COUNTERS, see increment
+LOCAL = threading.local()
+HISTOGRAMS = {}  # (name, labels): {'buckets': [counts], 'sum': total}
+# upper bounds of histogram buckets in seconds, the last one is +Inf
+BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+    30, 60,
+)
+METRICS = {
+    'presence_request_seconds': (
+        'histogram', 'Time of handling requests by endpoint.'
+    ),
+    'presence_requests_total': (
+        'counter', 'Handled requests by endpoint and status code.'
+    ),
+    'presence_cache_requests_total': (
+        'counter', 'Calls of cached functions by result: hit, stale or miss.'
+    ),
+    'presence_parse_seconds': (
+        'histogram',
+        'Time of parsing presence CSV by mode: full, append or shards.'
+    ),
+    'presence_parsed_rows_total': (
+        'counter', 'Rows of presence CSV parsed by result: valid, malformed.'
+    ),
+    'presence_xml_refreshes_total': (
+        'counter', 'Background refreshes of users XML by result.'
+    ),
+}
+
+
+def increment(name, value=1, **labels):
+    """
+    Increases counter of given name and labels.
+
+    Every thread counts in its own dict without locking, since counters
+    are increased on every cached call. Only the first increment in a
+    thread registers its dict, see counters.
+    """
+    thread_counters = getattr(LOCAL, 'counters', None)
+    if thread_counters is None:
+        thread_counters = LOCAL.counters = {}
+        with LOCK:
+            fold_exited()
+            THREAD_COUNTERS[threading.current_thread()] = thread_counters
+    key = (name, tuple(sorted(labels.items())))
+    thread_counters[key] = thread_counters.get(key, 0) + value
+
+
+def counters():
+    """
+    Returns values of all counters, summed over threads.
+    """
+    with LOCK:
+        fold_exited()
+        totals = dict(COUNTERS)
+        for thread_counters in THREAD_COUNTERS.values():
+            for key, value in thread_counters.items():
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def fold_exited():
+    """
+    Adds counters of exited threads to COUNTERS and drops their dicts.
+
+    Called with LOCK held. Exited threads don't change their counters
+    anymore, so they are read safely.
+    """
+    for thread, thread_counters in THREAD_COUNTERS.items():
+        if not thread.is_alive():
+            for key, value in thread_counters.iteritems():
+                COUNTERS[key] = COUNTERS.get(key, 0) + value
+            del THREAD_COUNTERS[thread]
+
+
+def clear():
+    """
+    Drops values of all counters and histograms.
+    """
+    with LOCK:
+        for thread_counters in THREAD_COUNTERS.values():
+            thread_counters.clear()
+        COUNTERS.clear()
+        HISTOGRAMS.clear()
+
+
+def observe(name, value, **labels):
+    """
+    Records value in histogram of given name and labels.
+    """
+    key = (name, tuple(sorted(labels.items())))
+    bucket = bisect_left(BUCKETS, value)
+    with LOCK:
+        histogram = HISTOGRAMS.get(key)
+        if histogram is None:
+            histogram = HISTOGRAMS[key] = {
+                'buckets': [0] * (len(BUCKETS) + 1),
+                'sum': 0.0,
+            }
+        histogram['buckets'][bucket] += 1
+        histogram['sum'] += value
+
+
+def render():
+    """
+    Returns all metrics in Prometheus text exposition format.
+    """
+    values = counters()
+    with LOCK:
+        histograms = {
+            key: (list(histogram['buckets']), histogram['sum'])
+            for key, histogram in HISTOGRAMS.iteritems()
+        }
+    lines = []
+    for name, (kind, description) in sorted(METRICS.iteritems()):
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for (metric, labels), value in sorted(values.iteritems()):
+            if metric == name:
+                lines.append(sample(name, labels, value))
+        for (metric, labels), (buckets, total) in sorted(
+                histograms.iteritems()):
+            if metric != name:
+                continue
+            count = 0
+            for bound, bucket in zip(BUCKETS + ('+Inf',), buckets):
+                count += bucket
+                lines.append(sample(
+                    name + '_bucket', labels + (('le', bound),), count
+                ))
+            lines.append(sample(name + '_sum', labels, total))
+            lines.append(sample(name + '_count', labels, count))
+    return '\n'.join(lines) + '\n'
+
+
+def sample(name, labels, value):
+    """
+    Formats single sample line.
+    """
+    if labels:
+        name += '{{{}}}'.format(','.join(
+            '{}="{}"'.format(label, escape(label_value))
+            for label, label_value in labels
+        ))
+    return '{} {}'.format(name, number(value))
+
+
+def escape(value):
+    """
+    Escapes label value.
+    """
+    return number(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def number(value):
+    """
+    Formats numbers without loss of precision, other values as text.
+    """
+    if isinstance(value, float):
+        return repr(value)
+    return unicode(value)
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Byte ranges of rows of single users in presence CSV files.
+"""
+
+import fcntl
+import logging
+import os
+import sys
+from array import array
+from binascii import hexlify, unhexlify
+from json import dumps, loads
+
+from files import atomic_write
+from parsing import SOURCE_TAIL_SIZE, appended_offset
+
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+OFFSETS = {}  # byte ranges of users in CSV files, see user_offsets
+OFFSETS_MAGIC = 'PREOFFS1'
+# JSON metadata is padded to fixed size, so it is rewritten in place
+OFFSETS_METADATA_SIZE = 3 * SOURCE_TAIL_SIZE
+OFFSETS_HEADER_SIZE = len(OFFSETS_MAGIC) + OFFSETS_METADATA_SIZE
+# blocks per user in sidecar above which it is rewritten with one per user
+COMPACT_BLOCKS = 8
+
+
+def user_offsets(path):
+    """
+    Returns byte ranges of rows of every user in CSV file.
+
+    It creates structure like this:
+    offsets = {
+        'user_id': array('l', [0, 3140, 88014, 88046]),
+    }
+    where every range is a pair of start and end offsets. Ranges are kept
+    in binary sidecar file next to the CSV file (path with .offsets
+    suffix) between restarts, see write_offsets. Like in
+    utils.load_presence only bytes appended since ranges were found are
+    scanned again, together with incomplete last line scanned before.
+    """
+    stat = os.stat(path)
+    previous = OFFSETS.get(path)
+    if previous is None:
+        previous = read_offsets(path)
+    with open(path, 'rb') as csvfile:
+        offset = appended_offset(csvfile, None, stat, previous)
+        if offset is None:
+            OFFSETS[path] = previous
+            return previous['users']
+        if offset:
+            users = dict(previous['users'])
+            if previous['size'] > offset:
+                trim_ranges(users, offset)
+        else:
+            previous = None
+            users = {}
+        appended, offset = scan_offsets(csvfile, offset)
+        size = csvfile.tell()
+        csvfile.seek(max(offset - SOURCE_TAIL_SIZE, 0))
+        tail = csvfile.read(min(offset, SOURCE_TAIL_SIZE))
+    for user_id, ranges in appended.iteritems():
+        if user_id in users:
+            ranges = extend_ranges(array('l', users[user_id]), ranges)
+        users[user_id] = ranges
+    offsets = {
+        'users': users,
+        'inode': (stat.st_dev, stat.st_ino),
+        'size': size,
+        'mtime': stat.st_mtime,
+        'offset': offset,
+        'tail': tail,
+    }
+    write_offsets(path, offsets, previous, appended)
+    OFFSETS[path] = offsets
+    return users
+
+
+def scan_offsets(csvfile, offset):
+    """
+    Finds byte ranges of rows from offset on without parsing them.
+
+    Rows of a user following each other make a single range. Returns
+    tuple (appended, offset) where appended are ranges of users found
+    and offset is right after the last complete line. Incomplete last
+    line is found too, like it is parsed by utils.load_presence, but it
+    is scanned again once it is finished.
+    """
+    csvfile.seek(offset)
+    user_ids = {}
+    appended = {}
+    for line in csvfile:
+        end = offset + len(line)
+        value = line[:line.find(',')]
+        user_id = user_ids.get(value)
+        if user_id is None:
+            try:
+                user_id = user_ids[value] = int(value)
+            except ValueError:
+                user_id = user_ids[value] = False
+        if user_id is not False:
+            ranges = appended.get(user_id)
+            if ranges is None:
+                ranges = appended[user_id] = array('l')
+            if ranges and ranges[-1] == offset:
+                ranges[-1] = end
+            else:
+                ranges.extend((offset, end))
+        if line.endswith('\n'):
+            offset = end
+    return appended, offset
+
+
+def extend_ranges(ranges, appended):
+    """
+    Adds appended ranges to ranges, joining adjacent ones. Returns ranges.
+    """
+    if ranges and appended and ranges[-1] == appended[0]:
+        ranges[-1] = appended[1]
+        appended = appended[2:]
+    ranges.extend(appended)
+    return ranges
+
+
+def trim_ranges(users, offset):
+    """
+    Cuts ranges of users at offset, so incomplete last line scanned before
+    is dropped. Trimmed ranges are copied, users without any left are
+    removed.
+    """
+    for user_id, ranges in users.items():
+        if ranges[-1] <= offset:
+            continue
+        ranges = array('l', ranges)
+        ranges[-1] = offset
+        if ranges[-2] == offset:
+            del ranges[-2:]
+        if ranges:
+            users[user_id] = ranges
+        else:
+            del users[user_id]
+
+
+def read_offsets(path):
+    """
+    Reads sidecar file of user_offsets, returns None when it is missing,
+    damaged or was written on incompatible platform.
+    """
+    try:
+        with open(path + '.offsets', 'rb') as sidecar:
+            fcntl.flock(sidecar, fcntl.LOCK_SH)
+            offsets = read_metadata(sidecar)
+            if offsets is None:
+                return None
+            values = array('l')
+            values.fromfile(sidecar, offsets['length'])
+    except (IOError, EOFError, ValueError, KeyError, TypeError):
+        return None
+    users = {}
+    position = 0
+    while position < len(values):
+        user_id = values[position]
+        end = position + 2 + 2 * values[position + 1]
+        ranges = values[position + 2:end]
+        if user_id in users:
+            extend_ranges(users[user_id], ranges)
+        else:
+            users[user_id] = ranges
+        position = end
+    offsets['users'] = users
+    return offsets
+
+
+def read_metadata(sidecar):
+    """
+    Reads metadata of sidecar file and leaves it at the first block.
+    """
+    sidecar.seek(0)
+    if sidecar.read(len(OFFSETS_MAGIC)) != OFFSETS_MAGIC:
+        return None
+    metadata = loads(sidecar.read(OFFSETS_METADATA_SIZE))
+    if metadata['byteorder'] != sys.byteorder or \
+            metadata['itemsize'] != array('l').itemsize:
+        return None
+    metadata['inode'] = tuple(metadata['inode'])
+    metadata['tail'] = unhexlify(metadata['tail'])
+    return metadata
+
+
+def write_offsets(path, offsets, previous, appended):
+    """
+    Writes sidecar file of user_offsets.
+
+    Sidecar consists of magic bytes, JSON metadata and blocks of native
+    long ints: user_id, number of ranges and the ranges. Ranges appended
+    to previous version of offsets are appended to its sidecar as new
+    blocks. Other changes, incomplete last line in previous version or
+    too many blocks per user write sidecar with one block per user aside
+    and rename it into place.
+
+    Number of long ints and blocks written is stored in offsets.
+    """
+    try:
+        if previous is not None and \
+                previous['size'] == previous['offset'] and \
+                previous['blocks'] + len(appended) <= \
+                COMPACT_BLOCKS * len(offsets['users']):
+            if append_offsets(path, offsets, previous, appended):
+                return
+        rewrite_offsets(path, offsets)
+    except (IOError, OSError):
+        log.warning('Cannot write offsets of %s', path, exc_info=True)
+
+
+def append_offsets(path, offsets, previous, appended):
+    """
+    Appends blocks of appended ranges to sidecar of previous offsets.
+
+    Blocks are written before metadata, so readers see the previous
+    version until the new one is complete. Returns False when sidecar
+    is not the one of previous offsets.
+    """
+    values = encode_blocks(appended)
+    offsets['length'] = previous['length'] + len(values)
+    offsets['blocks'] = previous['blocks'] + len(appended)
+    try:
+        sidecar = open(path + '.offsets', 'r+b')
+    except IOError:
+        return False
+    with sidecar:
+        fcntl.flock(sidecar, fcntl.LOCK_EX)
+        try:
+            metadata = read_metadata(sidecar)
+        except (ValueError, KeyError, TypeError):
+            return False
+        if metadata is None or any(
+                metadata[name] != previous[name]
+                for name in ('inode', 'offset', 'length')):
+            return False
+        sidecar.seek(
+            OFFSETS_HEADER_SIZE + previous['length'] * values.itemsize
+        )
+        values.tofile(sidecar)
+        sidecar.flush()
+        sidecar.seek(len(OFFSETS_MAGIC))
+        sidecar.write(encode_metadata(offsets))
+    return True
+
+
+def rewrite_offsets(path, offsets):
+    """
+    Writes sidecar with one block per user aside and renames it into
+    place.
+    """
+    values = encode_blocks(offsets['users'])
+    offsets['length'] = len(values)
+    offsets['blocks'] = len(offsets['users'])
+    with atomic_write(path + '.offsets') as sidecar:
+        sidecar.write(OFFSETS_MAGIC + encode_metadata(offsets))
+        values.tofile(sidecar)
+
+
+def encode_blocks(users):
+    """
+    Returns blocks of ranges of given users as long int array.
+    """
+    values = array('l')
+    for user_id, ranges in users.iteritems():
+        values.extend((user_id, len(ranges) // 2))
+        values.extend(ranges)
+    return values
+
+
+def encode_metadata(offsets):
+    """
+    Returns JSON metadata of offsets padded to OFFSETS_METADATA_SIZE.
+    """
+    metadata = {
+        name: offsets[name]
+        for name in ('inode', 'size', 'mtime', 'offset', 'length', 'blocks')
+    }
+    metadata.update(
+        tail=hexlify(offsets['tail']),
+        byteorder=sys.byteorder,
+        itemsize=array('l').itemsize,
+    )
+    return dumps(metadata).ljust(OFFSETS_METADATA_SIZE)
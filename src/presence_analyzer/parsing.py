@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Parsing of presence CSV files.
+"""
+
+import csv
+import gc
+import logging
+from datetime import datetime
+from functools import wraps
+
+import metrics
+
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+SOURCE_TAIL_SIZE = 4096
+EMPTY_WEEK = [{'count': 0, 'total': 0, 'start': 0, 'end': 0}] * 7
+
+
+def without_gc(function):
+    """
+    Disables cyclic garbage collector during function call.
+
+    Meant for functions creating lots of acyclic objects, like parsed
+    presence data, which would trigger many useless collections.
+    """
+    @wraps(function)
+    def collecting_later(*args, **kwargs):
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if enabled:
+                gc.enable()
+    return collecting_later
+
+
+def parse_presence(csvfile, chunk_size):
+    """
+    Parses presence CSV file in chunks of about chunk_size bytes.
+
+    Returns tuple (data, malformed) where data has structure described
+    in utils.get_data and malformed is number of skipped rows.
+    """
+    data = {}
+    malformed = 0
+    items = last_id = None
+    for rows, skipped in parse_chunks(
+            csvfile, chunk_size, parse_date, parse_time):
+        malformed += skipped
+        for user_id, date, start, end in rows:
+            if user_id != last_id:
+                items = data.setdefault(user_id, {})
+                last_id = user_id
+            items[date] = {'start': start, 'end': end}
+    return data, malformed
+
+
+def parse_chunks(csvfile, chunk_size, date_parser, time_parser):
+    """
+    Yields rows of presence CSV file parsed in chunks of about chunk_size
+    bytes.
+
+    Every column of a chunk is converted in one batch and each distinct
+    value only once, since the same user ids, dates and times repeat
+    across rows. Yields tuple (rows, malformed) for every chunk, where
+    rows are (user_id, date, start, end) tuples of values converted with
+    given parsers and malformed is number of skipped rows.
+    """
+    user_ids, dates, times = {}, {}, {}
+    while True:
+        lines = csvfile.readlines(chunk_size)
+        if not lines:
+            break
+        # ignore header and footer lines
+        rows = [row for row in csv.reader(lines) if len(row) == 4]
+        if not rows:
+            continue
+        columns = zip(*rows)
+        converted = [
+            convert_column(user_ids, columns[0], int),
+            convert_column(dates, columns[1], date_parser),
+            convert_column(times, columns[2], time_parser),
+            convert_column(times, columns[3], time_parser),
+        ]
+        rows = zip(*converted)
+        if any(None in column for column in converted):
+            rows = [row for row in rows if None not in row]
+        yield rows, len(columns[0]) - len(rows)
+
+
+def convert_column(converted, values, parse):
+    """
+    Returns values converted with parse function.
+
+    Parsed values are memoized in converted dict, values which can't be
+    parsed are converted to None.
+    """
+    for value in set(values).difference(converted):
+        try:
+            converted[value] = parse(value)
+        except (ValueError, TypeError):
+            log.debug('Problem with value %r', value, exc_info=True)
+            converted[value] = None
+    return map(converted.__getitem__, values)
+
+
+def parse_date(value):
+    """
+    Parses date in YYYY-MM-DD format.
+    """
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def parse_time(value):
+    """
+    Parses time in HH:MM:SS format.
+    """
+    return datetime.strptime(value, '%H:%M:%S').time()
+
+
+def parse_day(value):
+    """
+    Parses date in YYYY-MM-DD format to its proleptic Gregorian ordinal.
+    """
+    return parse_date(value).toordinal()
+
+
+def parse_seconds(value):
+    """
+    Parses time in HH:MM:SS format to seconds since midnight.
+    """
+    return seconds_since_midnight(parse_time(value))
+
+
+def seconds_since_midnight(time):
+    """
+    Calculates amount of seconds since midnight.
+    """
+    return time.hour * 3600 + time.minute * 60 + time.second
+
+
+def index_weekdays(index, appended, data):
+    """
+    Adds appended presence entries to weekday index.
+
+    Entries of data replaced by appended ones are subtracted first.
+    Updated users get new aggregates, so copies of index made before
+    stay unchanged.
+    """
+    for user_id, items in appended.iteritems():
+        previous = data.get(user_id, {})
+        weekdays = [
+            dict(aggregates) for aggregates in index.get(user_id, EMPTY_WEEK)
+        ]
+        for date, entry in items.iteritems():
+            if date in previous:
+                aggregate(weekdays[date.weekday()], previous[date], -1)
+            aggregate(weekdays[date.weekday()], entry, 1)
+        index[user_id] = weekdays
+
+
+def aggregate(aggregates, entry, sign):
+    """
+    Adds (sign is 1) or subtracts (sign is -1) entry from aggregates.
+    """
+    start = seconds_since_midnight(entry['start'])
+    end = seconds_since_midnight(entry['end'])
+    aggregates['count'] += sign
+    aggregates['total'] += sign * (end - start)
+    aggregates['start'] += sign * start
+    aggregates['end'] += sign * end
+
+
+def count_rows(valid, malformed, name):
+    """
+    Counts valid and malformed rows parsed from named data in metrics and
+    logs skipped malformed ones.
+    """
+    metrics.increment('presence_parsed_rows_total', valid, result='valid')
+    if malformed:
+        metrics.increment(
+            'presence_parsed_rows_total', malformed, result='malformed'
+        )
+        log.warning('Skipped %d malformed rows of %s', malformed, name)
+
+
+def appended_offset(csvfile, compressed, stat, previous):
+    """
+    Returns offset to parse file from, reusing previous parse of it.
+
+    It is the previous offset when file was only appended to (see
+    is_appended), None when file did not change and 0 when it is parsed
+    from scratch. Compressed file is parsed from scratch whenever it
+    changes.
+    """
+    if previous is None:
+        return 0
+    if compressed and stat.st_size != previous['size']:
+        return 0
+    if not is_appended(csvfile, stat, previous):
+        return 0
+    if stat.st_size == previous['size']:
+        return None
+    return previous['offset']
+
+
+def is_appended(csvfile, stat, previous):
+    """
+    Checks if file was only appended to since previous load.
+
+    Compares inode, size and mtime and makes sure that bytes right before
+    the previous offset did not change.
+    """
+    if (stat.st_dev, stat.st_ino) != previous['inode']:
+        return False
+    if stat.st_size < previous['size']:
+        return False
+    if stat.st_size == previous['size']:
+        return stat.st_mtime == previous['mtime']
+    tail = previous['tail']
+    csvfile.seek(previous['offset'] - len(tail))
+    return csvfile.read(len(tail)) == tail
+
+
+def last_line_end(csvfile, start, end):
+    """
+    Returns offset right after the last newline between start and end.
+    """
+    position = end
+    while position > start:
+        size = min(SOURCE_TAIL_SIZE, position - start)
+        csvfile.seek(position - size)
+        newline = csvfile.read(size).rfind('\n')
+        if newline != -1:
+            return position - size + newline + 1
+        position -= size
+    return start
+
+
+def parsed_end(csvfile, compressed, stat, offset):
+    """
+    Returns (size, offset, tail) of file parsed from offset to its end.
+
+    Offset is where the next incremental parse starts and tail are bytes
+    before it checked by is_appended. Compressed file is never parsed
+    incrementally.
+    """
+    if compressed:
+        return stat.st_size, stat.st_size, ''
+    size = csvfile.tell()
+    # incomplete last line is parsed again once it is finished
+    offset = last_line_end(csvfile, offset, size)
+    csvfile.seek(max(offset - SOURCE_TAIL_SIZE, 0))
+    return size, offset, csvfile.read(min(offset, SOURCE_TAIL_SIZE))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Sampled profiling of requests.
+"""
+
+import cProfile
+import glob
+import os
+import pstats
+import random
+from datetime import datetime
+
+from flask import request
+
+
+def install(app, directory):
+    """
+    Profiles PROFILE_RATE fraction of requests handled by application.
+
+    Views of sampled requests run under cProfile and their stats are
+    dumped to directory as profile-<endpoint>-<timestamp>.prof files.
+    Streamed responses are profiled until the response starts. Does
+    nothing when already installed.
+    """
+    if 'dispatch_request' in vars(app):
+        return
+    dispatch = app.dispatch_request
+
+    def dispatch_request():
+        """
+        Dispatches request, profiling it when sampled.
+        """
+        if random.random() >= app.config['PROFILE_RATE']:
+            return dispatch()
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(dispatch)
+        finally:
+            profile.dump_stats(os.path.join(
+                directory,
+                'profile-{}-{}-{}.prof'.format(
+                    request.endpoint or 'unknown',
+                    datetime.now().strftime('%Y%m%dT%H%M%S.%f'),
+                    os.getpid(),
+                )
+            ))
+
+    app.dispatch_request = dispatch_request
+
+
+def dumps(directory, endpoint='*'):
+    """
+    Returns paths of stats dumped by install for given endpoint.
+    """
+    return sorted(glob.glob(os.path.join(
+        directory, 'profile-{}-*.prof'.format(endpoint)
+    )))
+
+
+def aggregate(paths, stream, sort='cumulative', top=20):
+    """
+    Prints top functions of all given stats dumps together to stream.
+    """
+    stats = pstats.Stats(*paths, stream=stream)
+    stats.strip_dirs().sort_stats(sort).print_stats(top)
+    return stats
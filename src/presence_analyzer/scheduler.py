@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Background refreshing of presence and users data.
+"""
+
+import logging
+import threading
+from time import time
+
+import metrics
+from main import app
+from offsets import user_offsets
+from shards import start_pool
+from utils import (
+    is_database,
+    is_lazy,
+    is_loader,
+    is_shared,
+    load_database,
+    load_source,
+    publish_source
+)
+from xmldata import xml_data_parser, xml_update_data
+
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+STOP = threading.Event()
+SCHEDULER = {}  # running scheduler thread, see start
+
+
+def refresh_presence():
+    """
+    Loads new version of presence data aside and swaps it in.
+
+    In DATA_SHARED mode only the loader process loads and publishes it.
+    With sqlite DATA_ENGINE new rows are imported to database and in
+    DATA_LAZY mode only offsets of users are updated.
+    """
+    path = app.config['DATA_CSV']
+    if is_database(path):
+        load_database.refresh()
+    elif is_lazy(path):
+        user_offsets(path)
+    elif is_shared(path):
+        if is_loader(path):
+            publish_source(path, load_source.refresh())
+    else:
+        load_source.refresh()
+
+
+def refresh_users():
+    """
+    Downloads users xml file if it changed and parses it.
+
+    In DATA_SHARED mode only the loader process downloads it, the others
+    parse the file it replaced.
+    """
+    path = app.config['DATA_CSV']
+    if is_shared(path) and not is_loader(path):
+        xml_data_parser()
+        return
+    try:
+        updated = xml_update_data()
+    except Exception:
+        metrics.increment('presence_xml_refreshes_total', result='error')
+        raise
+    metrics.increment(
+        'presence_xml_refreshes_total',
+        result='updated' if updated else 'not_modified'
+    )
+    if updated:
+        xml_data_parser()
+
+
+def start():
+    """
+    Prepares data and starts thread refreshing it in the background.
+
+    Presence data is loaded and local users file parsed right away, so
+    requests only ever read prepared data. Pool of processes parsing
+    shards is started before, while this is the only thread. Jobs with
+    interval setting set to 0 are not run. Does nothing when already
+    started.
+    """
+    if 'thread' in SCHEDULER:
+        return
+    start_pool()
+    run(refresh_presence)
+    run(xml_data_parser)
+    now = time()
+    jobs = [
+        {'job': refresh_presence, 'setting': 'DATA_REFRESH_INTERVAL',
+         'next': now + app.config['DATA_REFRESH_INTERVAL']},
+        {'job': refresh_users, 'setting': 'XML_REFRESH_INTERVAL',
+         'next': now},
+    ]
+    STOP.clear()
+    thread = threading.Thread(target=loop, args=(jobs,), name='scheduler')
+    thread.daemon = True
+    SCHEDULER['thread'] = thread
+    thread.start()
+
+
+def stop():
+    """
+    Stops scheduler thread and waits for it to finish.
+    """
+    thread = SCHEDULER.pop('thread', None)
+    if thread is not None:
+        STOP.set()
+        thread.join()
+
+
+def loop(jobs):
+    """
+    Runs jobs on their intervals until stopped.
+    """
+    jobs = [job for job in jobs if app.config[job['setting']]]
+    while jobs and not STOP.is_set():
+        job = min(jobs, key=lambda job: job['next'])
+        if STOP.wait(max(job['next'] - time(), 0)):
+            break
+        run(job['job'])
+        job['next'] = time() + app.config[job['setting']]
+
+
+def run(job):
+    """
+    Runs job, logging its failure.
+    """
+    try:
+        job()
+    except Exception:  # pylint: disable=broad-except
+        log.exception('Refreshing with %s failed', job.__name__)
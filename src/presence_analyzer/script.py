@@ -6,7 +6,8 @@ import os
 import sys
 from functools import partial
 
-from utils import xml_update_data
+import utils
+import xmldata
 
 import paste.script.command
 import werkzeug.script
@@ -27,18 +28,33 @@ abspath = partial(os.path.join, _buildout_path)
 del _buildout_path
 
 
-# bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
-    from presence_analyzer import app
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False,
+             start_scheduler=False):
+    from presence_analyzer import app, profiling, scheduler
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    if app.config['PROFILE_RATE']:
+        profiling.install(
+            app, app.config['PROFILE_DIR'] or abspath('var', 'log')
+        )
+    # only served applications refresh data in background, command line
+    # tools would download XML twice or race with the server
+    if start_scheduler:
+        scheduler.start()
     return app
 
 
+# bin/paster serve parts/etc/deploy.ini
+def make_deploy(global_conf={}, **conf):
+    return make_app(global_conf, start_scheduler=True)
+
+
 # bin/paster serve parts/etc/debug.ini
 def make_debug(global_conf={}, **conf):
     from werkzeug.debug import DebuggedApplication
-    app = make_app(global_conf, config=DEBUG_CFG, debug=True)
+    app = make_app(
+        global_conf, config=DEBUG_CFG, debug=True, start_scheduler=True
+    )
     return DebuggedApplication(app, evalex=True)
 
 
@@ -85,7 +101,7 @@ def xml_update_data():
     Update data from xml file.
     """
     make_app()
-    xml_update_data()
+    xmldata.xml_update_data()
 
 # bin/flask-ctl ...
 def run():
@@ -119,4 +135,131 @@ def run():
         """Stop the application."""
         _serve('stop', dry_run=dry_run)
 
+    # bin/flask-ctl contention [--threads 8] [--requests 1000]
+    def action_contention(threads=8, requests=1000):
+        """Benchmark API requested from many threads at once.
+
+        Every thread requests users listing and statistics of the first
+        user through the test client of the deploy application.
+        """
+        from presence_analyzer import benchmark
+        app = make_app()
+        user_id = min(utils.get_weekday_index())
+        urls = [
+            '/api/v1/users',
+            '/api/v2/presence_weekday/{}'.format(user_id),
+            '/api/v2/mean_time_weekday/{}'.format(user_id),
+            '/api/v2/presence_start_end/{}'.format(user_id),
+        ]
+        for count in sorted(set([1, threads])):
+            result = benchmark.contention(app, urls, count, requests)
+            print (
+                '{threads} threads: {requests} requests ({failed} failed) '
+                'in {seconds:.2f} s, {throughput:.0f} requests/s'
+            ).format(**result)
+
+    # bin/flask-ctl benchmark [--users 100] [--days 365] [--baseline FILE]
+    def action_benchmark(users=100, days=365, seed=0, repeat=3,
+                         output='', baseline=''):
+        """Time utilities and views on synthetic data.
+
+        Data generated from 'seed' for given number of users and calendar
+        days is kept in var/benchmark and reused. Results are written to
+        'output' JSON file (var/benchmark/<timestamp>.json by default)
+        and compared with results in 'baseline' file when given.
+        """
+        import json
+        import time
+        from presence_analyzer import app, benchmark
+        directory = abspath('var', 'benchmark')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        results = benchmark.run(app, directory, users, days, seed, repeat)
+        output = output or os.path.join(
+            directory, time.strftime('%Y%m%d-%H%M%S.json')
+        )
+        benchmark.save(output, results)
+        print '{rows} rows of {users} users, results in {output}'.format(
+            output=output, **results['parameters']
+        )
+        for name, result in sorted(results['results'].items()):
+            print '{:30} {best:10.4f} s'.format(name, **result)
+        if baseline:
+            with open(baseline) as previous:
+                compared = benchmark.compare(json.load(previous), results)
+            print 'Compared with {}:'.format(baseline)
+            for name, before, after, ratio in compared:
+                print '{:30} {:10.4f} s {:10.4f} s {:7.2f}x'.format(
+                    name, before, after, ratio
+                )
+
+    # bin/flask-ctl loadtest [--url URL] [--threads 16] [--duration 10]
+    def action_loadtest(url='', threads=16, duration=10, reload_after=0,
+                        output=''):
+        """Load test the application over HTTP.
+
+        Requests the mix of API paths in benchmark.LOAD_TEST_MIX from many
+        threads and reports throughput and latency percentiles per path.
+
+        Options:
+         - 'url' of running application (bin/flask-ctl serve), the deploy
+           application is served from this process when not given
+         - '--reload-after' seconds after which presence data is loaded
+           again from scratch, served application only
+         - '--output' JSON file to write results to
+        """
+        import json
+        from presence_analyzer import benchmark
+        reloader = None
+        if not url:
+            app = make_app()
+            server, url = benchmark.serve(app)
+            if reload_after:
+                reloader = partial(benchmark.reload_data, app)
+        result = benchmark.load_test(
+            url, threads=threads, duration=duration, reloader=reloader,
+            reload_after=reload_after,
+        )
+        if output:
+            with open(output, 'w') as results:
+                json.dump(result, results, indent=2, sort_keys=True)
+        for title, part in [('All requests', result),
+                            ('During reload', result.get('reload'))]:
+            if part is None:
+                continue
+            print (
+                '{}: {requests} requests ({failed} failed) in {seconds:.1f} s'
+                ', {throughput:.0f} requests/s'
+            ).format(title, **part)
+            print '{:45} {:>8} {:>8} {:>8} {:>8} {:>7}'.format(
+                'path', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'failed'
+            )
+            for path, stats in sorted(part['paths'].items()):
+                print '{:45} {:8.1f} {:8.1f} {:8.1f} {:8.1f} {:7}'.format(
+                    path, stats['throughput'], stats['p50'] * 1000,
+                    stats['p95'] * 1000, stats['p99'] * 1000, stats['failed']
+                )
+
+    # bin/flask-ctl profile [--endpoint users_view] [--top 20]
+    def action_profile(endpoint='*', top=20, sort='cumulative'):
+        """Show top functions of profiled requests.
+
+        Aggregates stats of requests profiled with PROFILE_RATE setting.
+
+        Options:
+         - '--endpoint' name of view function, all by default
+         - '--top' number of functions to show
+         - '--sort' pstats sort key, like cumulative, tottime or calls
+        """
+        from presence_analyzer import app, profiling
+        app.config.from_pyfile(abspath(DEPLOY_CFG))
+        paths = profiling.dumps(
+            app.config['PROFILE_DIR'] or abspath('var', 'log'), endpoint
+        )
+        if not paths:
+            print 'No profiled requests of endpoint {}'.format(endpoint)
+            return
+        print '{} profiled requests'.format(len(paths))
+        profiling.aggregate(paths, sys.stdout, sort, top)
+
     werkzeug.script.run()
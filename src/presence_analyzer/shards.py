@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Loading of presence data split into shards.
+"""
+
+import glob
+import multiprocessing
+import os
+import threading
+from array import array
+from timeit import default_timer
+
+import compression
+import metrics
+from main import app
+from parsing import (
+    count_rows,
+    index_weekdays,
+    parse_presence,
+    without_gc
+)
+from store import PresenceStore
+
+
+SHARDS = {}  # DATA_CSV: parsed shards of it, see load_shards
+POOL = {}  # processes parsing shards, see start_pool
+
+
+def is_sharded(path):
+    """
+    Checks if DATA_CSV path is a directory or glob pattern of shards.
+    """
+    return glob.has_magic(path) or os.path.isdir(path)
+
+
+def load_shards(path, previous):
+    """
+    Parses shards of presence data and merges them.
+
+    Path is a directory, whose *.csv files (optionally compressed, like
+    *.csv.gz) are the shards, or a glob pattern. Shards changed since the
+    previous load are parsed in parallel by SHARD_PROCESSES processes
+    (one per CPU core by default, see parse_shards) and unchanged ones
+    are reused. Rows of shards later in sorted order replace rows of the
+    same user and day in earlier ones.
+
+    Returns a new source dict like utils.load_presence on every change
+    and previous source, returned by the previous load, when no shard
+    changed. Snapshots are not written for sharded data.
+    """
+    # pylint: disable=too-many-locals
+    if os.path.isdir(path):
+        paths = sorted(
+            shard for shard in glob.glob(os.path.join(path, '*.csv*'))
+            if shard.endswith(('.csv',) + compression.EXTENSIONS)
+        )
+    else:
+        paths = sorted(glob.glob(path))
+    identities = {}
+    for shard in paths:
+        stat = os.stat(shard)
+        identities[shard] = (
+            stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime
+        )
+    if previous is not None and previous['shards'] == identities:
+        return previous
+
+    parsed = SHARDS.get(path, {})
+    changed = [
+        shard for shard in paths
+        if parsed.get(shard, {}).get('identity') != identities[shard]
+    ]
+    parsed = {
+        shard: parsed[shard] for shard in paths if shard not in changed
+    }
+    started = default_timer()
+    for shard, (columns, index, malformed) in zip(
+            changed, parse_shards(changed)):
+        parsed[shard] = {
+            'identity': identities[shard],
+            'store': PresenceStore(*map(array_from_string, columns)),
+            'index': index,
+        }
+        count_rows(len(parsed[shard]['store']), malformed, shard)
+    if changed:
+        metrics.observe(
+            'presence_parse_seconds', default_timer() - started, mode='shards'
+        )
+    SHARDS[path] = parsed
+
+    shards = [parsed[shard] for shard in paths]
+    store, overlapping = PresenceStore.merge(
+        [shard['store'] for shard in shards]
+    )
+    index = {}
+    for shard in shards:
+        for user_id, weekdays in shard['index'].iteritems():
+            if user_id in index:
+                weekdays = [
+                    {name: total[name] + day[name] for name in day}
+                    for total, day in zip(index[user_id], weekdays)
+                ]
+            index[user_id] = weekdays
+    for user_id in overlapping:
+        index[user_id] = store.weekday_aggregates(user_id)
+    source = {
+        'data': None,
+        'index': index,
+        'store': store,
+        'snapshot': False,
+        'shards': identities,
+        'inode': tuple(sorted(
+            (shard, identity[:2]) for shard, identity in identities.items()
+        )),
+        'size': sum(identity[2] for identity in identities.itervalues()),
+        'mtime': max([0] + [
+            identity[3] for identity in identities.itervalues()
+        ]),
+    }
+    return source
+
+
+def start_pool():
+    """
+    Starts pool of processes parsing shards of DATA_CSV, when it is
+    sharded and SHARD_PROCESSES is not 1.
+
+    Pool processes are forked, so it is called before any other thread
+    starts, see scheduler.start. Process forked while another thread
+    holds a lock, like the one of a logging handler, would deadlock on
+    it. Does nothing when already started.
+    """
+    processes = app.config['SHARD_PROCESSES'] or multiprocessing.cpu_count()
+    if 'pool' in POOL or processes <= 1 or \
+            not is_sharded(app.config['DATA_CSV']):
+        return
+    POOL['pool'] = multiprocessing.Pool(processes)
+
+
+def parse_shards(paths):
+    """
+    Parses shards with parse_shard, in parallel when there are many.
+
+    Pool of start_pool is used when started. Otherwise temporary pool is
+    forked only by the only thread of process, like in command line
+    tools, and shards are parsed one by one in threaded processes.
+    """
+    pool = POOL.get('pool')
+    if pool is not None and len(paths) > 1:
+        return pool.map(parse_shard, paths, chunksize=1)
+    processes = min(
+        len(paths),
+        app.config['SHARD_PROCESSES'] or multiprocessing.cpu_count()
+    )
+    if processes <= 1 or threading.active_count() > 1:
+        return [parse_shard(shard) for shard in paths]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(parse_shard, paths, chunksize=1)
+    finally:
+        pool.terminate()
+
+
+@without_gc
+def parse_shard(path):
+    """
+    Parses single shard of presence data in pool process.
+
+    Returns tuple (columns, index, malformed) where columns are strings
+    of native int columns of store, which are cheap to send between
+    processes, and index is weekday index of the shard.
+    """
+    with open(path, 'rb') as csvfile:
+        data, malformed = parse_presence(
+            compression.decompressed(
+                csvfile, compression.detect(csvfile, path)
+            ),
+            app.config['CSV_CHUNK_SIZE']
+        )
+    store = PresenceStore.from_data(data)
+    index = {}
+    index_weekdays(index, data, {})
+    columns = [
+        column.tostring()
+        for column in (store.user_ids, store.days, store.starts, store.ends)
+    ]
+    return columns, index, malformed
+
+
+def array_from_string(string):
+    """
+    Returns native int array of string created by array.tostring.
+    """
+    column = array('i')
+    column.fromstring(string)
+    return column
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+"""
+Compact, array-backed storage of presence data.
+"""
+
+import ctypes
+import json
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import izip
+from collections import Mapping
+import datetime
+
+from files import atomic_write
+
+DAY = 24 * 60 * 60
+SNAPSHOT_MAGIC = 'PRESNAP1'
+SNAPSHOT_HEADER = struct.Struct('<8sI')
+AGGREGATES = ('count', 'total', 'start', 'end')
+
+
+def weekday(day):
+    """
+    Returns weekday (Monday is 0) of given proleptic Gregorian ordinal.
+    """
+    return (day - 1) % 7
+
+
+def running_sums(differences):
+    """
+    Returns occupancy of every weekday from its difference array, whose
+    last item only closes slots.
+    """
+    occupancy = []
+    for weekday_differences in differences:
+        present = 0
+        counts = []
+        for difference in weekday_differences[:-1]:
+            present += difference
+            counts.append(present)
+        occupancy.append(counts)
+    return occupancy
+
+
+class PresenceStore(object):
+
+    """
+    Presence entries kept in contiguous integer columns.
+
+    Rows are sorted by user_id and day, so entries of a single user occupy
+    a continuous slice described by per-user offsets:
+
+    store.user_ids = array('i', [10, 10, 11])
+    store.days = array('i', [735121, 735122, 735116])  # date.toordinal()
+    store.starts = array('i', [34745, 33592, 34088])   # seconds since midnight
+    store.ends = array('i', [64792, 58057, 57087])
+    store.users = array('i', [10, 11])
+    store.offsets = array('i', [0, 2, 3])
+    """
+
+    def __init__(self, user_ids, days, starts, ends):
+        """
+        Creates store from row-sorted columns.
+        """
+        self.user_ids = user_ids
+        self.days = days
+        self.starts = starts
+        self.ends = ends
+        self.users = array('i')
+        self.offsets = array('i')
+        for row, user_id in enumerate(user_ids):
+            if not self.users or self.users[-1] != user_id:
+                self.users.append(user_id)
+                self.offsets.append(row)
+        self.offsets.append(len(user_ids))
+        self.positions = {
+            user_id: position for position, user_id in enumerate(self.users)
+        }
+
+    @classmethod
+    def from_data(cls, data):
+        """
+        Creates store from the structure returned by get_data.
+        """
+        user_ids, days, starts, ends = (
+            array('i'), array('i'), array('i'), array('i')
+        )
+        seconds = {}
+        for user_id in sorted(data):
+            items = data[user_id]
+            dates = sorted(items)
+            entries = [items[date] for date in dates]
+            for entry in entries:
+                for time in (entry['start'], entry['end']):
+                    if time not in seconds:
+                        seconds[time] = (
+                            time.hour * 3600 + time.minute * 60 + time.second
+                        )
+            user_ids.extend([user_id] * len(dates))
+            days.extend([date.toordinal() for date in dates])
+            starts.extend([seconds[entry['start']] for entry in entries])
+            ends.extend([seconds[entry['end']] for entry in entries])
+        return cls(user_ids, days, starts, ends)
+
+    @classmethod
+    def merge(cls, stores):
+        """
+        Creates store from rows of many stores.
+
+        Rows of later stores replace rows of the same user and day in
+        earlier ones. Returns tuple (store, overlapping) where overlapping
+        is set of users whose days were not in order of stores, like
+        users with replaced rows.
+        """
+        user_ids, days, starts, ends = (
+            array('i'), array('i'), array('i'), array('i')
+        )
+        overlapping = set()
+        users = set()
+        for store in stores:
+            users.update(store.users)
+        for user_id in sorted(users):
+            begin = len(days)
+            for store in stores:
+                if user_id not in store:
+                    continue
+                first, last = store.user_slice(user_id)
+                if len(days) > begin and store.days[first] <= days[-1]:
+                    overlapping.add(user_id)
+                days.extend(store.days[first:last])
+                starts.extend(store.starts[first:last])
+                ends.extend(store.ends[first:last])
+            if user_id in overlapping:
+                rows = {}
+                for row in zip(days[begin:], starts[begin:], ends[begin:]):
+                    rows[row[0]] = row
+                rows = sorted(rows.values())
+                for column, values in zip((days, starts, ends), zip(*rows)):
+                    del column[begin:]
+                    column.extend(array('i', values))
+            user_ids.extend(array('i', [user_id]) * (len(days) - begin))
+        return cls(user_ids, days, starts, ends), overlapping
+
+    def to_data(self):
+        """
+        Returns the structure returned by get_data.
+
+        Equal dates and times share objects.
+        """
+        dates = {}
+        times = {}
+        data = {}
+        for position, user_id in enumerate(self.users):
+            begin = self.offsets[position]
+            end = self.offsets[position + 1]
+            items = data[user_id] = {}
+            for day, start, finish in zip(
+                    self.days[begin:end],
+                    self.starts[begin:end],
+                    self.ends[begin:end]):
+                if day not in dates:
+                    dates[day] = datetime.date.fromordinal(day)
+                for seconds in (start, finish):
+                    if seconds not in times:
+                        times[seconds] = datetime.time(
+                            seconds // 3600, seconds // 60 % 60, seconds % 60
+                        )
+                items[dates[day]] = {
+                    'start': times[start],
+                    'end': times[finish],
+                }
+        return data
+
+    def __len__(self):
+        return len(self.days)
+
+    def __contains__(self, user_id):
+        return user_id in self.positions
+
+    def user_slice(self, user_id):
+        """
+        Returns (begin, end) row range of given user.
+        """
+        position = self.positions[user_id]
+        return self.offsets[position], self.offsets[position + 1]
+
+    def days_slice(self, user_id, first=None, last=None):
+        """
+        Returns (begin, end) row range of given user limited to days from
+        first to last ordinal (inclusive), found by binary search.
+        """
+        begin, end = self.user_slice(user_id)
+        if first is not None:
+            begin = bisect_left(self.days, first, begin, end)
+        if last is not None:
+            end = bisect_right(self.days, last, begin, end)
+        return begin, end
+
+    def weekday_aggregates(self, user_id, first=None, last=None):
+        """
+        Returns weekday aggregates of given user like the weekday index,
+        limited to days from first to last ordinal (inclusive).
+        """
+        begin, end = self.days_slice(user_id, first, last)
+        result = [
+            {'count': 0, 'total': 0, 'start': 0, 'end': 0} for i in range(7)
+        ]
+        for day, start, finish in zip(
+                self.days[begin:end],
+                self.starts[begin:end],
+                self.ends[begin:end]):
+            aggregates = result[weekday(day)]
+            aggregates['count'] += 1
+            aggregates['total'] += finish - start
+            aggregates['start'] += start
+            aggregates['end'] += finish
+        return result
+
+    def occupancy(self, slot, first=None, last=None):
+        """
+        Returns number of users present in every slot of given width in
+        seconds by weekday, limited to days from first to last ordinal.
+
+        Returns tuple (days, occupancy) of per-weekday lists. Days are
+        numbers of distinct days with presence and occupancy lists hold
+        sums over those days of users present at any time of the slot.
+        Every row only marks its first slot and the slot after its last
+        one in a difference array, so the cost is O(rows + slots). Rows
+        not ending after their start are skipped.
+        """
+        slots = -(-DAY // slot)
+        differences = [[0] * (slots + 1) for i in range(7)]
+        days = [set() for i in range(7)]
+        if first is None and last is None:
+            columns = [izip(self.days, self.starts, self.ends)]
+        else:
+            columns = []
+            for user_id in self.users:
+                begin, end = self.days_slice(user_id, first, last)
+                columns.append(izip(
+                    self.days[begin:end],
+                    self.starts[begin:end],
+                    self.ends[begin:end],
+                ))
+        for rows in columns:
+            for day, start, finish in rows:
+                if finish <= start:
+                    continue
+                weekday_differences = differences[weekday(day)]
+                weekday_differences[start // slot] += 1
+                weekday_differences[-(-finish // slot)] -= 1
+                days[weekday(day)].add(day)
+        return (
+            [len(weekday_days) for weekday_days in days],
+            running_sums(differences),
+        )
+
+    def user_rows(self, user_id):
+        """
+        Returns (day, start, end) tuples of given user sorted by day.
+        """
+        begin, end = self.user_slice(user_id)
+        return zip(
+            self.days[begin:end],
+            self.starts[begin:end],
+            self.ends[begin:end],
+        )
+
+    def group_by_weekday(self, user_id):
+        """
+        Groups presence intervals of given user by weekday.
+        """
+        result = [[], [], [], [], [], [], []]
+        for day, start, end in self.user_rows(user_id):
+            result[weekday(day)].append(end - start)
+        return result
+
+    def group_by_start_end(self, user_id):
+        """
+        Groups start and end seconds of given user by weekday.
+        """
+        result = {i: {'start': [], 'end': []} for i in range(7)}
+        for day, start, end in self.user_rows(user_id):
+            result[weekday(day)]['start'].append(start)
+            result[weekday(day)]['end'].append(end)
+        return result
+
+
+def write_snapshot(path, store, index, metadata):
+    """
+    Writes store, weekday index and metadata to binary snapshot file.
+
+    Snapshot consists of a header, JSON metadata and fixed-width native
+    int columns: user_ids, days, starts, ends, users, offsets and then
+    count, total, start, end aggregates of every user and weekday.
+    File is written aside and renamed, so readers never see it partial.
+    """
+    metadata = dict(
+        metadata,
+        rows=len(store),
+        users=len(store.users),
+        byteorder=sys.byteorder,
+        itemsize=ctypes.sizeof(ctypes.c_int),
+    )
+    encoded = json.dumps(metadata)
+    encoded += ' ' * (-(SNAPSHOT_HEADER.size + len(encoded)) % 8)
+    aggregates = [array('i') for name in AGGREGATES]
+    for user_id in store.users:
+        for weekday_aggregates in index[user_id]:
+            for column, name in zip(aggregates, AGGREGATES):
+                column.append(weekday_aggregates[name])
+    with atomic_write(path) as snapshot:
+        snapshot.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(encoded)))
+        snapshot.write(encoded)
+        for column in [
+                store.user_ids, store.days, store.starts, store.ends,
+                store.users, store.offsets] + aggregates:
+            snapshot.write(column)
+
+
+def read_snapshot(path):
+    """
+    Reads snapshot written by write_snapshot without copying it.
+
+    Columns of returned store and weekday index are views of privately
+    memory-mapped file, so processes reading the same snapshot share its
+    pages in the page cache.
+
+    Returns tuple (store, index, metadata) or None when snapshot is
+    missing, damaged or was written on incompatible platform.
+    """
+    try:
+        with open(path, 'rb') as snapshot:
+            mapped = mmap.mmap(
+                snapshot.fileno(), 0, access=mmap.ACCESS_COPY
+            )
+    except (IOError, ValueError):
+        return None
+    try:
+        magic, length = SNAPSHOT_HEADER.unpack_from(mapped)
+        if magic != SNAPSHOT_MAGIC:
+            return None
+        position = SNAPSHOT_HEADER.size + length
+        metadata = json.loads(mapped[SNAPSHOT_HEADER.size:position])
+        if metadata['byteorder'] != sys.byteorder or \
+                metadata['itemsize'] != ctypes.sizeof(ctypes.c_int):
+            return None
+        columns = []
+        sizes = [metadata['rows']] * 4 + [
+            metadata['users'], metadata['users'] + 1
+        ] + [metadata['users'] * 7] * len(AGGREGATES)
+        for size in sizes:
+            column = (ctypes.c_int * size).from_buffer(mapped, position)
+            columns.append(column)
+            position += ctypes.sizeof(column)
+    except (struct.error, ValueError, KeyError):
+        return None
+    store = PresenceStore.__new__(PresenceStore)
+    (
+        store.user_ids, store.days, store.starts, store.ends,
+        store.users, store.offsets
+    ) = columns[:6]
+    store.positions = {
+        user_id: position for position, user_id in enumerate(store.users)
+    }
+    return store, SnapshotIndex(store.positions, *columns[6:]), metadata
+
+
+class SnapshotIndex(Mapping):
+
+    """
+    Read-only weekday index reading aggregates from snapshot columns.
+
+    Behaves like the dict returned by get_weekday_index, but creates
+    weekday aggregates of a user only when asked for them.
+    """
+
+    def __init__(self, positions, counts, totals, starts, ends):
+        # pylint: disable=too-many-arguments
+        self.positions = positions
+        self.counts = counts
+        self.totals = totals
+        self.starts = starts
+        self.ends = ends
+
+    def __getitem__(self, user_id):
+        begin = self.positions[user_id] * 7
+        return [
+            {
+                'count': self.counts[i],
+                'total': self.totals[i],
+                'start': self.starts[i],
+                'end': self.ends[i],
+            }
+            for i in xrange(begin, begin + 7)
+        ]
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def __len__(self):
+        return len(self.positions)
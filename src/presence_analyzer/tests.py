@@ -4,15 +4,38 @@ Presence analyzer unit tests.
 """
 from __future__ import unicode_literals
 
+import BaseHTTPServer
+import bz2
 import datetime
+import fcntl
+import gzip
 import json
+import os
 import os.path
+import shutil
+import tempfile
+import threading
 import unittest
+import urllib2
+from contextlib import closing
+from StringIO import StringIO
 from time import time
 
+import benchmark
+import compression
+import files
+import importer
 import main
+import metrics
+import offsets
+import parsing
+import profiling
+import scheduler
+import shards
+import store
 import utils
 import views
+import xmldata
 
 
 TEST_DATA_CSV = os.path.join(
@@ -22,6 +45,40 @@ TEST_XML_DATA = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_users.xml'
 )
 
+
+class UsersXmlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """
+    Local stand-in of intranet server of users.xml.
+    """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Serves users.xml with ETag, broken when server.broken is set.
+        """
+        self.server.requests.append(dict(self.headers))
+        if self.server.broken == 'error':
+            self.send_error(500)
+            return
+        if self.headers.get('If-None-Match') == '"users-1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', '"users-1"')
+        self.send_header('Content-Type', 'application/xml')
+        missing = 100 if self.server.broken == 'truncated' else 0
+        self.send_header('Content-Length', len(self.server.body) + missing)
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, *args):
+        """
+        Keeps test output clean.
+        """
+        pass
+
+
 # pylint: disable=maybe-no-member, too-many-public-methods
 class PresenceAnalyzerViewsTestCase(unittest.TestCase):
 
@@ -114,6 +171,105 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(data[0], expected_list[0])
         self.assertEqual(data[-1], expected_list[-1])
 
+    def test_aggregate_stats(self):
+        """
+        Test weekday statistics of all users and groups together.
+        """
+        resp = self.client.get('/api/v2/aggregate_stats')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['users'], 2)
+        self.assertEqual(data['presence_weekday'], [
+            ['Weekday', 'Presence (s)'],
+            ['Mon', 24123],
+            ['Tue', 46611],
+            ['Wed', 49786],
+            ['Thu', 69673],
+            ['Fri', 6426],
+            ['Sat', 0],
+            ['Sun', 0]
+        ])
+        self.assertEqual(data['mean_time_weekday'][1], ['Tue', 23305.5])
+        self.assertEqual(len(data['presence_start_end']), 7)
+
+        resp = self.client.get(
+            '/api/v2/aggregate_stats?user_ids=10,12&from=2013-09-11'
+        )
+        data = json.loads(resp.data)
+        self.assertEqual(data['users'], 1)
+        self.assertEqual(data['presence_weekday'][1:5], [
+            ['Mon', 0], ['Tue', 0], ['Wed', 24465], ['Thu', 23705]
+        ])
+        resp = self.client.get('/api/v2/aggregate_stats?user_ids=10,x')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_occupancy(self):
+        """
+        Test mean number of users present in time slots.
+        """
+        resp = self.client.get('/api/v2/occupancy?slot=60')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 7)
+        self.assertEqual(data[1]['weekday'], 'Tue')
+        self.assertEqual(data[1]['days'], 1)
+        self.assertEqual(len(data[1]['occupancy']), 24)
+        self.assertEqual(data[1]['occupancy'][8:19], [
+            0, 2, 2, 2, 2, 2, 1, 1, 1, 1, 0
+        ])
+        self.assertEqual(data[3]['days'], 2)
+        self.assertEqual(data[3]['occupancy'][10], 1.5)
+        self.assertEqual(data[3]['occupancy'][9], 0.5)
+        self.assertEqual(data[6], {
+            'weekday': 'Sun', 'days': 0, 'occupancy': [0] * 24
+        })
+
+        resp = self.client.get('/api/v2/occupancy?from=2013-09-12')
+        data = json.loads(resp.data)
+        self.assertEqual(data[1]['days'], 0)
+        self.assertEqual(len(data[3]['occupancy']), 96)
+        self.assertEqual(data[3]['occupancy'][43:45], [2, 2])
+        for slot in ('0', '1441', 'x'):
+            resp = self.client.get('/api/v2/occupancy?slot=' + slot)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_date_range(self):
+        """
+        Test per-user views limited to dates from and to.
+        """
+        resp = self.client.get(
+            '/api/v2/presence_weekday/11?from=2013-09-06&to=2013-09-12'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), [
+            ['Weekday', 'Presence (s)'],
+            ['Mon', 24123],
+            ['Tue', 16564],
+            ['Wed', 25321],
+            ['Thu', 22969],
+            ['Fri', 0],
+            ['Sat', 0],
+            ['Sun', 0]
+        ])
+        resp = self.client.get('/api/v2/mean_time_weekday/11?to=2013-09-05')
+        self.assertEqual(json.loads(resp.data)[3], ['Thu', 22999])
+        resp = self.client.get(
+            '/api/v2/presence_start_end/11?from=2013-09-14'
+        )
+        self.assertEqual(json.loads(resp.data)[0], ['Mon', 0, 0])
+        resp = self.client.get(
+            '/api/v2/weekday_stats?user_ids=10,11,12&from=2013-09-12'
+        )
+        data = json.loads(resp.data)
+        self.assertEqual(data[0]['presence_weekday'][4], ['Thu', 23705])
+        self.assertEqual(data[1]['presence_weekday'][5], ['Fri', 6426])
+        self.assertEqual(data[2]['presence_weekday'], [])
+        resp = self.client.get('/api/v2/presence_weekday/12?from=2013-09-06')
+        self.assertEqual(json.loads(resp.data), [])
+
+        resp = self.client.get('/api/v2/presence_weekday/11?from=2013-9')
+        self.assertEqual(resp.status_code, 400)
+
     def test_presence_start_end(self):
         """
         Test start and end time of given user grouped by weekday.
@@ -134,6 +290,289 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(data[0], expected_list[0])
         self.assertEqual(data[-1], expected_list[-1])
 
+    def test_metrics(self):
+        """
+        Test metrics of requests and cache are exposed.
+        """
+        self.client.get('/api/v1/users')
+        self.client.get('/api/v2/presence_weekday/10')
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/plain')
+        self.assertIn(
+            '# TYPE presence_request_seconds histogram', resp.data
+        )
+        self.assertIn(
+            'presence_request_seconds_bucket{endpoint="users_view",le="+Inf"}',
+            resp.data
+        )
+        self.assertIn(
+            'presence_requests_total{endpoint="presence_weekday_view",'
+            'status="200"}',
+            resp.data
+        )
+        self.assertIn(
+            'presence_cache_requests_total{function="load_source",'
+            'result="hit"}',
+            resp.data
+        )
+
+    def test_metrics_of_errors(self):
+        """
+        Test requests failed with unhandled exception are recorded.
+        """
+        main.app.config['XML_DATA'] = TEST_XML_DATA + '.missing'
+        main.app.logger.disabled = True
+        self.addCleanup(setattr, main.app.logger, 'disabled', False)
+        key = (
+            'presence_requests_total',
+            (('endpoint', 'xml_data_view'), ('status', 500)),
+        )
+        failed = metrics.counters().get(key, 0)
+        resp = self.client.get('/api/v2/users')
+        self.assertEqual(resp.status_code, 500)
+        self.assertEqual(metrics.counters()[key], failed + 1)
+
+    def test_conditional_response(self):
+        """
+        Test unchanged data is answered with 304 Not Modified.
+        """
+        resp = self.client.get('/api/v2/presence_weekday/11')
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers['ETag']
+        last_modified = resp.headers['Last-Modified']
+
+        resp = self.client.get(
+            '/api/v2/presence_weekday/11',
+            headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        resp = self.client.get(
+            '/api/v2/presence_weekday/11',
+            headers={'If-Modified-Since': last_modified}
+        )
+        self.assertEqual(resp.status_code, 304)
+
+        resp = self.client.get(
+            '/api/v2/presence_weekday/11',
+            headers={
+                'If-None-Match': '"other"',
+                'If-Modified-Since': last_modified,
+            }
+        )
+        self.assertEqual(resp.status_code, 200)
+
+        for url in [
+                '/api/v2/presence_weekday/11?from=garbage',
+                '/api/v2/weekday_stats?user_ids=x',
+                '/api/v2/aggregate_stats?to=garbage',
+                '/api/v2/occupancy?slot=abc']:
+            resp = self.client.get(
+                url,
+                headers={
+                    'If-None-Match': etag,
+                    'If-Modified-Since': last_modified,
+                }
+            )
+            self.assertEqual(resp.status_code, 400)
+
+    def test_validators_of_sources(self):
+        """
+        Test views check versions of their own data sources only.
+        """
+        main.app.config['XML_DATA'] = TEST_XML_DATA + '.missing'
+        for url in ('/api/v1/users', '/api/v2/presence_weekday/11'):
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('ETag', resp.headers)
+
+        main.app.config['XML_DATA'] = TEST_XML_DATA
+        self.addCleanup(utils.CACHE.pop, 'load_source', None)
+        utils.CACHE.pop('load_source', None)
+        resp = self.client.get('/api/v2/users')
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('load_source', utils.CACHE)
+        resp = self.client.get(
+            '/api/v2/users',
+            headers={'If-Modified-Since': resp.headers['Last-Modified']}
+        )
+        self.assertEqual(resp.status_code, 304)
+
+        main.app.config['XML_DATA'] = TEST_XML_DATA + '.missing'
+        self.assertIsNone(utils.data_version(('xml',)))
+        self.assertIsNotNone(utils.data_version(('csv',)))
+
+    def test_weekday_stats(self):
+        """
+        Test batch statistics match single user views.
+        """
+        resp = self.client.get('/api/v2/weekday_stats')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual([stats['user_id'] for stats in data], [10, 11])
+        for stats in data:
+            for name in (
+                    'mean_time_weekday',
+                    'presence_weekday',
+                    'presence_start_end'):
+                resp = self.client.get(
+                    '/api/v2/{}/{}'.format(name, stats['user_id'])
+                )
+                self.assertEqual(stats[name], json.loads(resp.data))
+
+        resp = self.client.get('/api/v2/weekday_stats?user_ids=11,12')
+        data = json.loads(resp.data)
+        self.assertEqual([stats['user_id'] for stats in data], [11, 12])
+        self.assertEqual(data[1], {
+            'user_id': 12,
+            'mean_time_weekday': [],
+            'presence_weekday': [],
+            'presence_start_end': [],
+        })
+
+        resp = self.client.get('/api/v2/weekday_stats?user_ids=11,x')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_weekday_stats_reloaded(self):
+        """
+        Test batch statistics streamed during reload come from one version.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({'DATA_CSV': path, 'JSON_CHUNK_SIZE': 1})
+        self.addCleanup(main.app.config.update, {'JSON_CHUNK_SIZE': 65536})
+        self.addCleanup(utils.CACHE.clear)
+        utils.CACHE.clear()
+        expected = self.client.get('/api/v2/weekday_stats').data
+
+        resp = self.client.get('/api/v2/weekday_stats')
+        chunks = iter(resp.response)
+        first = next(chunks)
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n11,2013-09-16,09:00:00,17:00:00\n')
+        utils.CACHE.clear()
+        self.assertEqual(first + ''.join(chunks), expected)
+        self.assertNotEqual(
+            self.client.get('/api/v2/weekday_stats').data, expected
+        )
+
+    def test_sqlite_engine(self):
+        """
+        Test all endpoints respond the same with sqlite storage engine.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config['DATA_CSV'] = path
+        self.addCleanup(main.app.config.update, {'DATA_ENGINE': 'memory'})
+        self.addCleanup(utils.CACHE.clear)
+        urls = [
+            '/api/v1/users',
+            '/api/v2/mean_time_weekday/10',
+            '/api/v2/presence_weekday/11',
+            '/api/v2/presence_start_end/11',
+            '/api/v2/presence_weekday/11?from=2013-09-06&to=2013-09-12',
+            '/api/v2/mean_time_weekday/12',
+            '/api/v2/weekday_stats',
+            '/api/v2/weekday_stats?user_ids=10,12&from=2013-09-12',
+            '/api/v2/aggregate_stats',
+            '/api/v2/aggregate_stats?user_ids=11,12&to=2013-09-10',
+            '/api/v2/occupancy?slot=60',
+            '/api/v2/occupancy?slot=7&from=2013-09-10',
+        ]
+
+        def responses(engine):
+            """
+            Returns data and ETags of all urls with given engine.
+            """
+            main.app.config['DATA_ENGINE'] = engine
+            utils.CACHE.clear()
+            return [
+                (resp.data, resp.headers['ETag'])
+                for resp in map(self.client.get, urls)
+            ]
+
+        self.assertEqual(responses('sqlite'), responses('memory'))
+        self.assertTrue(os.path.exists(path + '.sqlite'))
+        with open(path, 'a') as csvfile:
+            csvfile.write(
+                '\n12,2013-09-10,09:39:05,17:59:52\n'
+                '10,2013-09-12,10:00:00,11:00:00\n'
+            )
+        self.assertEqual(responses('sqlite'), responses('memory'))
+
+    def test_lazy_engine(self):
+        """
+        Test per-user endpoints respond the same when users are loaded
+        lazily, with incomplete last line of the file too.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config['DATA_CSV'] = path
+        self.addCleanup(main.app.config.update, {'DATA_LAZY': False})
+        self.addCleanup(offsets.OFFSETS.pop, path, None)
+        self.addCleanup(utils.CACHE.clear)
+        urls = ['/api/v1/users', '/api/v2/weekday_stats'] + [
+            '/api/v2/{}/{}'.format(view, user_id)
+            for view in (
+                'mean_time_weekday', 'presence_weekday', 'presence_start_end'
+            )
+            for user_id in (10, 11, 12)
+        ]
+
+        def responses(lazy):
+            """
+            Returns data of all urls with users loaded lazily or not.
+            """
+            main.app.config['DATA_LAZY'] = lazy
+            utils.CACHE.clear()
+            return [resp.data for resp in map(self.client.get, urls)]
+
+        self.assertEqual(responses(False), responses(True))
+        resp = self.client.get('/api/v2/presence_weekday/11')
+        self.assertEqual(json.loads(resp.data)[5], ['Fri', 6426])
+
+    def test_weekday_index_views(self):
+        """
+        Test statistics views agree with grouping of full user history.
+        """
+        data = utils.get_data()
+        for user_id in data:
+            weekdays = utils.group_by_weekday(data[user_id])
+            start_end = utils.group_by_start_end(data[user_id])
+            resp = self.client.get(
+                '/api/v2/mean_time_weekday/{}'.format(user_id)
+            )
+            self.assertEqual(
+                [mean for day, mean in json.loads(resp.data)],
+                [utils.mean(intervals) for intervals in weekdays]
+            )
+            resp = self.client.get(
+                '/api/v2/presence_weekday/{}'.format(user_id)
+            )
+            self.assertEqual(
+                [total for day, total in json.loads(resp.data)[1:]],
+                [sum(intervals) for intervals in weekdays]
+            )
+            resp = self.client.get(
+                '/api/v2/presence_start_end/{}'.format(user_id)
+            )
+            self.assertEqual(
+                [[start, end] for day, start, end in json.loads(resp.data)],
+                [
+                    [utils.mean(day['start']), utils.mean(day['end'])]
+                    for weekday, day in sorted(start_end.items())
+                ]
+            )
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
 
@@ -156,18 +595,102 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
 
     def test_cache(self):
         """
-        Test cache decorator for get_data function.
+        Test cache decorator for load_source function.
         """
-        CACHE = utils.CACHE
-        self.assertEqual(CACHE, {})
-        data = utils.get_data()
-        self.assertNotEqual(CACHE, {})
-        self.assertEqual(CACHE['get_data']['data'], data)
-        cache_time = CACHE['get_data']['time']
-        CACHE['get_data']['time'] = time() + 86400
-        utils.get_data()
-        self.assertNotEqual(cache_time, CACHE['get_data']['time'])
-        CACHE = {}
+        source = utils.get_source()
+        self.assertIs(utils.CACHE['load_source'][((), ())]['data'], source)
+        self.assertIs(utils.get_source(), source)
+        self.assertIs(utils.get_data(), source['data'])
+
+    def test_cache_arguments(self):
+        """
+        Test results are cached per arguments with limited size.
+        """
+        calls = []
+        self.addCleanup(utils.CACHE.pop, 'cached', None)
+
+        @utils.cache(600, size=2)
+        def cached(number, power=1):
+            """
+            Records call and returns a result.
+            """
+            calls.append((number, power))
+            return number ** power
+
+        self.assertEqual(cached(2), 2)
+        self.assertEqual(cached(2, power=3), 8)
+        self.assertEqual(cached(2), 2)
+        self.assertEqual(calls, [(2, 1), (2, 3)])
+        self.assertEqual(cached(3), 3)
+        self.assertEqual(len(utils.CACHE['cached']), 2)
+        self.assertEqual(cached(2, power=3), 8)
+        self.assertEqual(calls, [(2, 1), (2, 3), (3, 1), (2, 3)])
+
+        main.app.config['CACHE_CONFIG']['cached'] = {'size': 1}
+        self.addCleanup(main.app.config['CACHE_CONFIG'].pop, 'cached')
+        cached(4)
+        self.assertEqual(len(utils.CACHE['cached']), 1)
+
+    def test_cache_stale_while_revalidate(self):
+        """
+        Test expired result is returned while it is refreshed.
+        """
+        results = [1, 2]
+        self.addCleanup(utils.CACHE.pop, 'stale', None)
+
+        @utils.cache(600)
+        def stale():
+            """
+            Returns next result.
+            """
+            return results.pop(0)
+
+        self.assertEqual(stale(), 1)
+        utils.CACHE['stale'][((), ())]['time'] -= 600
+        self.assertEqual(stale(), 1)
+        refreshing = utils.REFRESHING.get(('stale', ((), ())))
+        if refreshing is not None:
+            refreshing.join()
+        self.assertEqual(stale(), 2)
+        self.assertEqual(utils.REFRESHING, {})
+
+    def test_cache_concurrent(self):
+        """
+        Test concurrent misses compute result once and hits do not wait.
+        """
+        calls = []
+        computing = threading.Event()
+        release = threading.Event()
+        self.addCleanup(utils.CACHE.pop, 'slow', None)
+
+        @utils.cache(600)
+        def slow(number):
+            """
+            Records call and waits until released.
+            """
+            calls.append(number)
+            computing.set()
+            release.wait()
+            return number
+
+        release.set()
+        self.assertEqual(slow(1), 1)
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(slow(2)))
+            for i in range(4)
+        ]
+        release.clear()
+        computing.clear()
+        for thread in threads:
+            thread.start()
+        computing.wait()
+        self.assertEqual(slow(1), 1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [2] * 4)
+        self.assertEqual(calls, [1, 2])
 
     def test_get_data(self):
         """
@@ -184,11 +707,508 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             datetime.time(9, 39, 5)
         )
 
+    def test_parse_presence(self):
+        """
+        Test parsing of CSV chunks with malformed rows.
+        """
+        csvfile = StringIO(
+            'user_id,date,start,end,extra\n'
+            '10,2013-09-10,09:39:05,17:59:52\n'
+            '10,2013-09-11,09:19:52,16:07:37\n'
+            'x,2013-09-12,09:19:52,16:07:37\n'
+            '11,2013-13-05,09:28:08,15:51:27\n'
+            '11,2013-09-09,25:12:14,15:54:17\n'
+            '11,2013-09-10,09:12:14,15:54:17\n'
+        )
+        data, malformed = parsing.parse_presence(csvfile, 64)
+        self.assertEqual(malformed, 3)
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertItemsEqual(
+            data[10].keys(),
+            [datetime.date(2013, 9, 10), datetime.date(2013, 9, 11)]
+        )
+        self.assertEqual(
+            data[11][datetime.date(2013, 9, 10)],
+            {
+                'start': datetime.time(9, 12, 14),
+                'end': datetime.time(15, 54, 17),
+            }
+        )
+
+    def test_load_presence(self):
+        """
+        Test appended rows are merged and replaced file is parsed again.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write(
+                '10,2013-09-10,09:39:05,17:59:52\n'
+                '11,2013-09-10,09:19:52,16:07:3'
+            )
+        data = utils.load_presence(path)['data']
+        self.assertEqual(
+            data[11][datetime.date(2013, 9, 10)]['end'],
+            datetime.time(16, 7, 3)
+        )
+        self.assertIs(utils.load_presence(path)['data'], data)
+
+        with open(path, 'a') as csvfile:
+            csvfile.write(
+                '7\n'
+                '10,2013-09-11,09:39:05,17:59:52\n'
+            )
+        source = utils.load_presence(path)
+        self.assertIsNone(source['data'])
+        appended = utils.source_data(source)
+        self.assertEqual(source['offset'], os.path.getsize(path))
+        self.assertEqual(len(data[10]), 1)
+        self.assertEqual(len(appended[10]), 2)
+        self.assertEqual(
+            appended[11][datetime.date(2013, 9, 10)]['end'],
+            datetime.time(16, 7, 37)
+        )
+        self.assertEqual(
+            utils.SOURCES[path]['index'][11][1],
+            {'count': 1, 'total': 24465, 'start': 33592, 'end': 58057}
+        )
+        self.assertEqual(
+            [day['count'] for day in utils.SOURCES[path]['index'][10]],
+            [0, 1, 1, 0, 0, 0, 0]
+        )
+
+        replacement = os.path.join(tmpdir, 'new.csv')
+        with open(replacement, 'w') as csvfile:
+            csvfile.write('12,2013-09-11,09:39:05,17:59:52\n')
+        os.rename(replacement, path)
+        self.assertItemsEqual(utils.load_presence(path)['data'].keys(), [12])
+
+    def test_load_compressed(self):
+        """
+        Test compressed files are decompressed while they are parsed.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with open(TEST_DATA_CSV, 'rb') as csvfile:
+            content = csvfile.read()
+        expected = utils.load_presence(TEST_DATA_CSV)['data']
+        half = len(content) // 2
+        gzipped = os.path.join(tmpdir, 'data.csv.gz')
+        for part in (content[:half], content[half:]):
+            with gzip.open(gzipped, 'ab') as gzfile:
+                gzfile.write(part)
+        bzipped = os.path.join(tmpdir, 'data.csv.bz2')
+        with closing(bz2.BZ2File(bzipped, 'wb')) as bzfile:
+            bzfile.write(content)
+        unknown = os.path.join(tmpdir, 'data')
+        shutil.copy(gzipped, unknown)
+        for path, name in [(gzipped, 'gzip'), (bzipped, 'bzip2'),
+                           (unknown, 'gzip')]:
+            with open(path, 'rb') as csvfile:
+                self.assertEqual(compression.detect(csvfile, path), name)
+                self.assertEqual(csvfile.tell(), 0)
+            source = utils.load_presence(path)
+            self.assertEqual(source['data'], expected)
+            self.assertIs(utils.load_presence(path), source)
+
+        with gzip.open(gzipped, 'ab') as gzfile:
+            gzfile.write(b'\n12,2013-09-10,09:39:05,17:59:52\n')
+        self.assertItemsEqual(
+            utils.load_presence(gzipped)['data'], [10, 11, 12]
+        )
+
+        stream = compression.DecompressedFile(
+            iter([b'1\n2', b'\n3\n4', b'5'])
+        )
+        self.assertEqual(stream.readlines(2), ['1\n'])
+        self.assertEqual(stream.readlines(2), ['2\n', '3\n'])
+        self.assertEqual(stream.readlines(2), ['45'])
+        self.assertEqual(stream.readlines(2), [])
+
+    def test_stream_json(self):
+        """
+        Test streamed JSON list is encoded like a list at once.
+        """
+        items = [{'user_id': i, 'name': 'User {}'.format(i)} for i in range(9)]
+        chunks = list(utils.stream_json(iter(items), 64))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(''.join(chunks), json.dumps(items))
+        self.assertEqual(list(utils.stream_json(iter([]), 64)), ['[]'])
+
+    def test_load_shards(self):
+        """
+        Test shards are parsed, merged and reused while unchanged.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        paths = [os.path.join(tmpdir, name) for name in ('a.csv', 'b.csv')]
+        with open(TEST_DATA_CSV) as csvfile:
+            lines = csvfile.read().splitlines(True)
+        for shard, shard_lines in zip(paths, (lines[::2], lines[1::2])):
+            with open(shard, 'w') as csvfile:
+                csvfile.writelines(shard_lines)
+        with open(os.path.join(tmpdir, 'ignored.txt'), 'w') as other:
+            other.write('12,2013-09-10,09:39:05,17:59:52\n')
+        main.app.config.update({'DATA_CSV': tmpdir, 'SHARD_PROCESSES': 2})
+        self.addCleanup(main.app.config.update, {'SHARD_PROCESSES': 0})
+        self.addCleanup(shards.SHARDS.clear)
+        shards.start_pool()
+        pool = shards.POOL['pool']
+        self.addCleanup(pool.terminate)
+        self.addCleanup(shards.POOL.clear)
+        shards.start_pool()
+        self.assertIs(shards.POOL['pool'], pool)
+
+        source = shards.load_shards(tmpdir, None)
+        expected = utils.load_presence(TEST_DATA_CSV)
+        self.assertEqual(utils.source_data(source), expected['data'])
+        self.assertEqual(source['index'], expected['index'])
+        self.assertIs(shards.load_shards(tmpdir, source), source)
+        glob_source = shards.load_shards(
+            os.path.join(tmpdir, '*.csv'), None
+        )
+        self.assertEqual(glob_source['index'], source['index'])
+
+        parsed = shards.SHARDS[tmpdir][paths[0]]
+        with open(paths[1], 'a') as csvfile:
+            csvfile.write(
+                '10,2013-09-10,10:00:00,11:00:00\n'
+                '12,2013-09-10,09:39:05,17:59:52\n'
+            )
+        source = shards.load_shards(tmpdir, source)
+        self.assertIs(shards.SHARDS[tmpdir][paths[0]], parsed)
+        data = utils.source_data(source)
+        self.assertItemsEqual(data, [10, 11, 12])
+        self.assertEqual(
+            data[10][datetime.date(2013, 9, 10)],
+            {'start': datetime.time(10, 0), 'end': datetime.time(11, 0)}
+        )
+        self.assertEqual(source['index'][10][1]['total'], 3600)
+        self.assertEqual(source['index'][10][1]['count'], 1)
+        self.assertEqual(len(source['store']), 10)
+
+        os.remove(paths[0])
+        source = shards.load_shards(tmpdir, source)
+        self.assertEqual(shards.SHARDS[tmpdir].keys(), [paths[1]])
+        self.assertEqual(len(source['store']), 6)
+
+        self.addCleanup(utils.CACHE.pop, 'load_source', None)
+        self.addCleanup(utils.SOURCES.pop, tmpdir, None)
+        utils.CACHE.pop('load_source', None)
+        self.assertEqual(utils.get_source()['index'], source['index'])
+        self.assertIs(utils.get_source(), utils.SOURCES[tmpdir])
+
+    def test_load_user(self):
+        """
+        Test users are loaded one by one from offsets sidecar in lazy mode.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        with open(TEST_DATA_CSV) as csvfile:
+            lines = csvfile.read().splitlines(True)
+        with open(path, 'w') as csvfile:
+            csvfile.write('user_id,date,start,end\n')
+            csvfile.writelines(lines[:4])
+            csvfile.write(lines[-1] + '\n10,2013-09-1')
+        main.app.config.update({'DATA_CSV': path, 'DATA_LAZY': True})
+        self.addCleanup(main.app.config.update, {'DATA_LAZY': False})
+        self.addCleanup(utils.CACHE.pop, 'load_user', None)
+        self.addCleanup(offsets.OFFSETS.pop, path, None)
+        self.addCleanup(utils.CACHE.pop, 'load_source', None)
+        utils.CACHE.pop('load_source', None)
+
+        ranges = offsets.user_offsets(path)
+        self.assertItemsEqual(ranges, [10, 11])
+        # incomplete last line is indexed too
+        self.assertEqual(len(ranges[10]), 4)
+        self.assertEqual(len(ranges[11]), 2)
+        self.assertEqual(utils.get_user_ids(), [10, 11])
+        self.assertEqual(
+            utils.get_user_weekdays(11)[3],
+            {'count': 1, 'total': 22999, 'start': 34088, 'end': 57087}
+        )
+        self.assertEqual(
+            utils.get_user_weekdays(11, last=datetime.date(2013, 9, 4)),
+            utils.EMPTY_WEEK
+        )
+        self.assertIsNone(utils.get_user_weekdays(12))
+        self.assertNotIn('load_source', utils.CACHE)
+
+        main.app.config['CACHE_CONFIG']['load_user'] = {'size': 1}
+        self.addCleanup(main.app.config['CACHE_CONFIG'].pop, 'load_user')
+        utils.get_user_weekdays(10)
+        self.assertEqual(len(utils.CACHE['load_user']), 1)
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('8,09:00:00,10:00:00\n')
+        del offsets.OFFSETS[path]
+        self.assertEqual(len(offsets.user_offsets(path)[10]), 4)
+        sidecar = os.stat(path + '.offsets')
+        with open(path, 'a') as csvfile:
+            csvfile.write('12,2013-09-10,09:00:00,10:00:0')
+        del offsets.OFFSETS[path]
+        self.assertEqual(len(offsets.user_offsets(path)[12]), 2)
+        self.assertEqual(os.stat(path + '.offsets').st_ino, sidecar.st_ino)
+        self.assertGreater(
+            os.path.getsize(path + '.offsets'), sidecar.st_size
+        )
+        self.assertEqual(
+            offsets.read_offsets(path)['users'],
+            offsets.OFFSETS[path]['users']
+        )
+        self.assertEqual(utils.get_user_weekdays(10)[2]['count'], 2)
+        self.assertEqual(utils.get_user_ids(), [10, 11, 12])
+        self.assertEqual(utils.get_user_weekdays(12)[1]['total'], 3600)
+        self.assertNotIn('load_source', utils.CACHE)
+
+        utils.CACHE.pop('load_user')
+        self.assertEqual(utils.aggregate_stats([10, 11])['users'], 2)
+        self.assertEqual(
+            utils.get_weekdays_reader()(11), utils.get_weekday_index()[11]
+        )
+        self.assertEqual(
+            utils.aggregate_stats(first=datetime.date(2013, 9, 10))['users'],
+            3
+        )
+        self.assertNotIn('load_user', utils.CACHE)
+
+    def test_import_presence(self):
+        """
+        Test appended rows are imported to database and replaced file is
+        imported again.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write(
+                'user_id,date,start,end\n'
+                '10,2013-09-10,09:39:05,17:59:52\n'
+                '11,2013-09-10,09:19:52,16:07:3'
+            )
+        self.addCleanup(importer.DATABASES.pop, path, None)
+        source = importer.import_presence(path)
+        database = source['database']
+        self.assertEqual(len(database), 2)
+        self.assertEqual(database.user_ids(), [10, 11])
+        self.assertEqual(
+            database.weekday_aggregates(10)[1],
+            {'count': 1, 'total': 30047, 'start': 34745, 'end': 64792}
+        )
+        self.assertEqual(
+            database.weekday_aggregates(10, last=735120), utils.EMPTY_WEEK
+        )
+        self.assertEqual(
+            importer.import_presence(path)['size'], source['size']
+        )
+
+        with open(path, 'a') as csvfile:
+            csvfile.write(
+                '7\n'
+                '10,2013-09-10,10:00:00,11:00:00\n'
+                '10,2013-09-11,09:39:05,17:59:52\n'
+            )
+        source = importer.import_presence(path)
+        self.assertEqual(source['offset'], os.path.getsize(path))
+        self.assertEqual(len(database), 3)
+        self.assertEqual(database.weekday_aggregates(11)[1]['end'], 58057)
+        self.assertEqual(
+            database.weekday_aggregates(10)[1],
+            {'count': 1, 'total': 3600, 'start': 36000, 'end': 39600}
+        )
+        self.assertEqual(
+            database.group_aggregates([10, 11, 12]),
+            database.group_aggregates(),
+        )
+        self.assertEqual(database.group_aggregates([12])[0], 0)
+
+        importer.DATABASES.clear()
+        self.assertEqual(
+            importer.import_presence(path)['offset'], source['offset']
+        )
+        replacement = os.path.join(tmpdir, 'new.csv')
+        with open(replacement, 'w') as csvfile:
+            csvfile.write('12,2013-09-11,09:39:05,17:59:52\n')
+        os.rename(replacement, path)
+        self.assertEqual(
+            importer.import_presence(path)['database'].user_ids(), [12]
+        )
+
+    def test_load_snapshot(self):
+        """
+        Test new process starts from binary snapshot of previous load.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({'DATA_SNAPSHOT': True})
+        self.addCleanup(main.app.config.update, {'DATA_SNAPSHOT': False})
+        loaded = utils.load_presence(path)
+        self.assertTrue(os.path.exists(utils.snapshot_path(path)))
+
+        del utils.SOURCES[path]
+        source = utils.load_presence(path)
+        self.assertIsNone(source['data'])
+        self.assertEqual(source['index'], loaded['index'])
+        self.assertEqual(utils.source_data(source), loaded['data'])
+
+        del utils.SOURCES[path]
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-11,09:39:05,17:59:52\n')
+        source = utils.load_presence(path)
+        self.assertItemsEqual(utils.source_data(source), [10, 11, 12])
+        self.assertEqual(source['index'][12][2]['count'], 1)
+        self.assertFalse(source['snapshot'])
+        self.assertLess(source['snapshot_offset'], source['offset'])
+
+        main.app.config.update({'DATA_SNAPSHOT_THRESHOLD': 0})
+        self.addCleanup(
+            main.app.config.update,
+            {'DATA_SNAPSHOT_THRESHOLD': 16 * 1024 * 1024}
+        )
+        with open(path, 'a') as csvfile:
+            csvfile.write('13,2013-09-11,09:39:05,17:59:52\n')
+        source = utils.load_presence(path)
+        self.assertTrue(source['snapshot'])
+        del utils.SOURCES[path]
+        snapshot = utils.load_presence(path)
+        self.assertEqual(snapshot['offset'], os.path.getsize(path))
+        self.assertEqual(dict(snapshot['index']), source['index'])
+
+    def test_get_shared_source(self):
+        """
+        Test processes read data published by loader process.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({'DATA_CSV': path, 'DATA_SHARED': True})
+        self.addCleanup(main.app.config.update, {'DATA_SHARED': False})
+        self.addCleanup(utils.CACHE.pop, 'load_source', None)
+        utils.CACHE.pop('load_source', None)
+
+        # other process is the loader, but did not publish anything yet
+        lockfile = open(utils.snapshot_path(path) + '.lock', 'a')
+        self.addCleanup(lockfile.close)
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        source = utils.get_source()
+        self.assertIs(source, utils.load_source())
+        self.assertFalse(utils.is_loader(path))
+
+        utils.save_snapshot(path, utils.load_presence(path))
+        shared = utils.get_source()
+        self.assertIsNot(shared, source)
+        self.assertIsNone(shared['data'])
+        self.assertEqual(dict(shared['index']), source['index'])
+        self.assertIs(utils.get_source(), shared)
+        # data loaded before the snapshot was published is dropped
+        self.assertNotIn('load_source', utils.CACHE)
+        self.assertNotIn(path, utils.SOURCES)
+
+        # other process exited, this one takes over loading
+        fcntl.flock(lockfile, fcntl.LOCK_UN)
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-11,09:39:05,17:59:52\n')
+        shared = utils.get_source()
+        self.assertTrue(utils.is_loader(path))
+        self.assertIn(12, shared['index'])
+        self.assertIsNone(shared['data'])
+
+    def test_shared_without_lock(self):
+        """
+        Test data is loaded by every process when loader lock can't be
+        opened.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        os.mkdir(utils.snapshot_path(path) + '.lock')
+        main.app.config.update({'DATA_CSV': path, 'DATA_SHARED': True})
+        self.addCleanup(main.app.config.update, {'DATA_SHARED': False})
+        self.addCleanup(utils.LOADERS.pop, path, None)
+        self.addCleanup(utils.CACHE.pop, 'load_source', None)
+        utils.CACHE.pop('load_source', None)
+        self.assertFalse(utils.is_shared(path))
+        self.assertIs(utils.get_source(), utils.load_source())
+        self.assertFalse(os.path.exists(utils.snapshot_path(path)))
+
+    def test_xml_data_parser_cache(self):
+        """
+        Test parsed users are kept until xml file changes.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'users.xml')
+        shutil.copy(TEST_XML_DATA, path)
+        main.app.config.update({'XML_DATA': path})
+        data = xmldata.xml_data_parser()
+        self.assertIs(xmldata.xml_data_parser(), data)
+
+        with open(path) as xmlfile:
+            content = xmlfile.read()
+        with open(path, 'w') as xmlfile:
+            xmlfile.write(content.replace('Adam P.', 'Adam Pe.'))
+        data = xmldata.xml_data_parser()
+        self.assertEqual(data[141]['name'], 'Adam Pe.')
+        self.assertEqual(
+            data[16]['avatar'],
+            'https://intranet.stxnext.pl/api/images/users/16'
+        )
+
+    def test_xml_update_data(self):
+        """
+        Test conditional and atomic update of xml file.
+        """
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), UsersXmlHandler)
+        server.requests = []
+        server.broken = None
+        with open(TEST_XML_DATA) as xmlfile:
+            server.body = xmlfile.read()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.shutdown)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'users.xml')
+        with open(path, 'w') as xmlfile:
+            xmlfile.write('old')
+        main.app.config.update({
+            'XML_DATA': path,
+            'UPDATE_XML_DATA': 'http://127.0.0.1:{}/users.xml'.format(
+                server.server_port
+            ),
+        })
+
+        self.assertTrue(xmldata.xml_update_data())
+        with open(path) as xmlfile:
+            self.assertEqual(xmlfile.read(), server.body)
+        self.assertNotIn('If-None-Match', server.requests[-1])
+
+        self.assertFalse(xmldata.xml_update_data())
+        self.assertEqual(server.requests[-1]['if-none-match'], '"users-1"')
+
+        os.remove(path + '.validators')
+        with open(path, 'w') as xmlfile:
+            xmlfile.write('old')
+        for broken in ('truncated', 'error'):
+            server.broken = broken
+            with self.assertRaises(IOError):
+                xmldata.xml_update_data()
+            with open(path) as xmlfile:
+                self.assertEqual(xmlfile.read(), 'old')
+        self.assertEqual(os.listdir(tmpdir), ['users.xml'])
+
     def test_xml_data_parser(self):
         """
         Test xml data parser.
         """
-        data = utils.xml_data_parser()
+        data = xmldata.xml_data_parser()
         self.assertIsInstance(data, dict)
         self.assertIsInstance(data.keys()[0], int)
         self.assertEqual(
@@ -267,6 +1287,25 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         data = utils.group_by_start_end(days)
         self.assertEqual(data, excepted_result)
 
+    def test_atomic_write(self):
+        """
+        Test file is replaced only when written completely.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data')
+        with files.atomic_write(path) as output:
+            output.write('first')
+            self.assertFalse(os.path.exists(path))
+        with self.assertRaises(IOError):
+            with files.atomic_write(path) as output:
+                output.write('second')
+                raise IOError('Failed')
+        with open(path) as written:
+            self.assertEqual(written.read(), 'first')
+        self.assertEqual(os.listdir(tmpdir), ['data'])
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+
     def test_seconds_since_midnight(self):
         """
         Test calculates amount of seconds since midnight.
@@ -329,6 +1368,522 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(date[2], -16604)
 
 
+class PresenceBenchmarkTestCase(unittest.TestCase):
+
+    """
+    Benchmark suite tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_generate(self):
+        """
+        Test generated data are repeatable and parse like real data.
+        """
+        path = os.path.join(self.tmpdir, 'data.csv')
+        other = os.path.join(self.tmpdir, 'other.csv')
+        benchmark.generate_presence(path, 3, 14, seed=1)
+        benchmark.generate_presence(other, 3, 14, seed=1)
+        with open(path) as csvfile, open(other) as othercsvfile:
+            self.assertEqual(csvfile.read(), othercsvfile.read())
+        with open(path) as csvfile:
+            data, malformed = parsing.parse_presence(csvfile, 1024)
+        self.assertEqual(malformed, 0)
+        self.assertItemsEqual(data, [10, 11, 12])
+        for items in data.values():
+            for date, entry in items.items():
+                self.assertLess(date.weekday(), 5)
+                self.assertLessEqual(entry['start'], entry['end'])
+
+        path = os.path.join(self.tmpdir, 'users.xml')
+        benchmark.generate_users(path, 3, seed=1)
+        self.assertItemsEqual(xmldata.parse_users(path), [10, 11, 12])
+
+    def test_run(self):
+        """
+        Test all benchmarks run and configuration is restored.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        results = benchmark.run(main.app, self.tmpdir, 2, 7, repeat=1)
+        self.assertEqual(main.app.config['DATA_CSV'], TEST_DATA_CSV)
+        self.assertEqual(results['parameters']['users'], 2)
+        self.assertGreater(results['parameters']['rows'], 0)
+        self.assertIn('get_data cold', results['results'])
+        self.assertIn('load_presence gzip', results['results'])
+        self.assertIn('/api/v2/weekday_stats', results['results'])
+        path = os.path.join(self.tmpdir, 'results.json')
+        benchmark.save(path, results)
+        with open(path) as output:
+            compared = benchmark.compare(json.load(output), results)
+        self.assertEqual(len(compared), len(results['results']))
+        self.assertTrue(all(ratio == 1 for name, _, _, ratio in compared))
+
+    def test_load_test(self):
+        """
+        Test load test reports latencies of served application.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'XML_DATA': TEST_XML_DATA})
+        server, url = benchmark.serve(main.app)
+        self.addCleanup(server.shutdown)
+        reloads = []
+        result = benchmark.load_test(
+            url, [('/api/v1/users', 1), ('/api/v2/missing/{user_id}', 1)],
+            threads=2, duration=0.3, reloader=lambda: reloads.append(1),
+            reload_after=0.1
+        )
+        self.assertEqual(reloads, [1])
+        self.assertEqual(result['threads'], 2)
+        self.assertGreater(result['requests'], 0)
+        users = result['paths']['/api/v1/users']
+        self.assertEqual(users['failed'], 0)
+        self.assertLessEqual(users['p50'], users['p95'])
+        self.assertLessEqual(users['p95'], users['p99'])
+        missing = result['paths']['/api/v2/missing/{user_id}']
+        self.assertEqual(missing['failed'], missing['requests'])
+        self.assertIn('paths', result['reload'])
+
+    def test_reload_data(self):
+        """
+        Test data is parsed again on reload even when snapshot is saved.
+        """
+        path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({'DATA_CSV': path, 'DATA_SNAPSHOT': True})
+        self.addCleanup(main.app.config.update, {'DATA_SNAPSHOT': False})
+        self.addCleanup(utils.SOURCES.pop, path, None)
+        self.addCleanup(utils.CACHE.clear)
+        utils.CACHE.clear()
+        metrics.clear()
+        loaded = utils.get_source()
+        self.assertTrue(os.path.exists(utils.snapshot_path(path)))
+        benchmark.reload_data(main.app)
+        self.assertIsNot(utils.get_source(), loaded)
+        self.assertEqual(utils.get_source()['index'], loaded['index'])
+        self.assertIn(
+            'presence_parse_seconds_count{mode="full"} 2', metrics.render()
+        )
+        self.assertTrue(os.path.exists(utils.snapshot_path(path)))
+
+    def test_percentile(self):
+        """
+        Test nearest rank percentile.
+        """
+        samples = [(latency, True) for latency in range(100, 0, -1)]
+        self.assertEqual(benchmark.percentile(samples, 0.5), 50)
+        self.assertEqual(benchmark.percentile(samples, 0.99), 99)
+        self.assertEqual(benchmark.percentile(samples[:1], 0.5), 100)
+
+
+class PresenceMetricsTestCase(unittest.TestCase):
+
+    """
+    Metrics tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.addCleanup(metrics.clear)
+        metrics.clear()
+
+    def test_render(self):
+        """
+        Test counters and cumulative histograms in text format.
+        """
+        metrics.increment('presence_parsed_rows_total', 5, result='valid')
+        metrics.increment('presence_parsed_rows_total', 2, result='valid')
+        metrics.increment('presence_xml_refreshes_total', result='a"b')
+        metrics.observe('presence_parse_seconds', 0.003, mode='full')
+        metrics.observe('presence_parse_seconds', 0.2, mode='full')
+        metrics.observe('presence_parse_seconds', 100, mode='full')
+        lines = metrics.render().splitlines()
+        self.assertIn('# TYPE presence_parse_seconds histogram', lines)
+        self.assertIn(
+            'presence_parsed_rows_total{result="valid"} 7', lines
+        )
+        self.assertIn('presence_xml_refreshes_total{result="a\\"b"} 1', lines)
+        self.assertIn(
+            'presence_parse_seconds_bucket{mode="full",le="0.001"} 0', lines
+        )
+        self.assertIn(
+            'presence_parse_seconds_bucket{mode="full",le="0.005"} 1', lines
+        )
+        self.assertIn(
+            'presence_parse_seconds_bucket{mode="full",le="0.25"} 2', lines
+        )
+        self.assertIn(
+            'presence_parse_seconds_bucket{mode="full",le="+Inf"} 3', lines
+        )
+        self.assertIn('presence_parse_seconds_count{mode="full"} 3', lines)
+        self.assertIn('presence_parse_seconds_sum{mode="full"} 100.203', lines)
+
+    def test_counters_of_threads(self):
+        """
+        Test counters of threads are summed and kept after threads exit.
+        """
+        thread = threading.Thread(
+            target=metrics.increment,
+            args=('presence_parsed_rows_total', 3), kwargs={'result': 'valid'}
+        )
+        thread.start()
+        thread.join()
+        metrics.increment('presence_parsed_rows_total', 2, result='valid')
+        self.assertEqual(
+            metrics.counters()[
+                ('presence_parsed_rows_total', (('result', 'valid'),))
+            ],
+            5
+        )
+        self.assertNotIn(thread, metrics.THREAD_COUNTERS)
+
+    def test_load_presence(self):
+        """
+        Test parsing is timed and malformed rows are counted.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write(
+                '10,2013-09-10,09:39:05,17:59:52\n'
+                'x,2013-09-10,09:19:52,16:07:37\n'
+            )
+        self.addCleanup(utils.SOURCES.pop, path, None)
+        utils.load_presence(path)
+        self.assertEqual(
+            metrics.counters()[
+                ('presence_parsed_rows_total', (('result', 'malformed'),))
+            ],
+            1
+        )
+        self.assertEqual(
+            metrics.HISTOGRAMS[
+                ('presence_parse_seconds', (('mode', 'full'),))
+            ]['buckets'][-1],
+            0
+        )
+
+    def test_load_user(self):
+        """
+        Test malformed rows of users loaded in lazy mode are counted.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write(
+                '10,2013-09-10,09:39:05,17:59:52\n'
+                '10,2013-09-11,09:19:52,16:07:3x\n'
+            )
+        main.app.config.update({'DATA_CSV': path, 'DATA_LAZY': True})
+        self.addCleanup(main.app.config.update, {'DATA_LAZY': False})
+        self.addCleanup(main.app.config.update, {'DATA_CSV': TEST_DATA_CSV})
+        self.addCleanup(utils.CACHE.pop, 'load_user', None)
+        self.addCleanup(offsets.OFFSETS.pop, path, None)
+        self.assertEqual(utils.get_user_weekdays(10)[1]['count'], 1)
+        for result, count in (('valid', 1), ('malformed', 1)):
+            self.assertEqual(
+                metrics.counters()[
+                    ('presence_parsed_rows_total', (('result', result),))
+                ],
+                count
+            )
+
+
+class PresenceProfilingTestCase(unittest.TestCase):
+
+    """
+    Request profiling tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'XML_DATA': TEST_XML_DATA})
+        self.addCleanup(main.app.config.update, {'PROFILE_RATE': 0})
+        self.addCleanup(vars(main.app).pop, 'dispatch_request', None)
+        profiling.install(main.app, self.tmpdir)
+        self.client = main.app.test_client()
+
+    def test_install(self):
+        """
+        Test sampled requests are profiled into directory.
+        """
+        profiling.install(main.app, self.tmpdir + '.other')
+        self.client.get('/api/v1/users')
+        self.assertEqual(profiling.dumps(self.tmpdir), [])
+
+        main.app.config['PROFILE_RATE'] = 1
+        self.assertEqual(self.client.get('/api/v1/users').status_code, 200)
+        self.client.get('/api/v2/presence_weekday/10')
+        self.client.get('/api/v2/presence_weekday/11')
+        self.assertEqual(len(profiling.dumps(self.tmpdir)), 3)
+        paths = profiling.dumps(self.tmpdir, 'presence_weekday_view')
+        self.assertEqual(len(paths), 2)
+
+        stream = StringIO()
+        stats = profiling.aggregate(paths, stream, top=5)
+        self.assertEqual(
+            sum(
+                calls for (_, _, function), (calls, _, _, _, _)
+                in stats.stats.items() if function == 'presence_weekday_view'
+            ),
+            2
+        )
+        self.assertIn('function calls', stream.getvalue())
+
+
+class PresenceSchedulerTestCase(unittest.TestCase):
+
+    """
+    Background refreshing tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'data.csv')
+        with open(self.path, 'w') as csvfile:
+            csvfile.write('10,2013-09-10,09:39:05,17:59:52\n')
+        config = main.app.config.copy()
+        self.addCleanup(main.app.config.update, config)
+        main.app.config.update({
+            'DATA_CSV': self.path,
+            'XML_DATA': TEST_XML_DATA,
+            'DATA_REFRESH_INTERVAL': 0.01,
+            'XML_REFRESH_INTERVAL': 0,
+        })
+        self.addCleanup(utils.CACHE.pop, 'load_source', None)
+        utils.CACHE.pop('load_source', None)
+
+    def test_start(self):
+        """
+        Test data is loaded on start and refreshed in the background.
+        """
+        self.addCleanup(scheduler.stop)
+        scheduler.start()
+        thread = scheduler.SCHEDULER['thread']
+        source = utils.CACHE['load_source'][((), ())]['data']
+        self.assertItemsEqual(source['index'], [10])
+        scheduler.start()
+        self.assertIs(scheduler.SCHEDULER['thread'], thread)
+
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('11,2013-09-10,09:19:52,16:07:37\n')
+        timeout = time() + 5
+        while 11 not in utils.get_source()['index'] and time() < timeout:
+            threading.Event().wait(0.01)
+        self.assertItemsEqual(utils.get_source()['index'], [10, 11])
+        self.assertItemsEqual(source['index'], [10])
+
+        scheduler.stop()
+        self.assertFalse(thread.is_alive())
+        self.assertNotIn('thread', scheduler.SCHEDULER)
+
+    def test_refresh_users_shared(self):
+        """
+        Test only the loader process downloads users in DATA_SHARED mode.
+        """
+        main.app.config.update({
+            'DATA_SHARED': True,
+            'UPDATE_XML_DATA': 'http://127.0.0.1:1/users.xml',
+        })
+        self.addCleanup(utils.LOADERS.pop, self.path, None)
+        lockfile = open(utils.snapshot_path(self.path) + '.lock', 'a')
+        self.addCleanup(lockfile.close)
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        scheduler.refresh_users()
+        self.assertIn(TEST_XML_DATA, xmldata.USERS)
+
+        fcntl.flock(lockfile, fcntl.LOCK_UN)
+        with self.assertRaises(urllib2.URLError):
+            scheduler.refresh_users()
+
+
+class PresenceStoreTestCase(unittest.TestCase):
+
+    """
+    Compact store tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.data = {
+            11: {
+                datetime.date(2013, 9, 12): {
+                    'start': datetime.time(8, 0, 0),
+                    'end': datetime.time(16, 0, 0),
+                },
+                datetime.date(2013, 9, 10): {
+                    'start': datetime.time(9, 39, 5),
+                    'end': datetime.time(17, 59, 52),
+                },
+            },
+            10: {
+                datetime.date(2013, 9, 17): {
+                    'start': datetime.time(10, 0, 0),
+                    'end': datetime.time(10, 30, 0),
+                },
+            },
+        }
+        self.store = store.PresenceStore.from_data(self.data)
+
+    def test_from_data(self):
+        """
+        Test columns are sorted by user and day with per-user offsets.
+        """
+        self.assertEqual(len(self.store), 3)
+        self.assertEqual(list(self.store.users), [10, 11])
+        self.assertEqual(list(self.store.offsets), [0, 1, 3])
+        self.assertEqual(list(self.store.user_ids), [10, 11, 11])
+        self.assertEqual(
+            list(self.store.days),
+            [
+                datetime.date(2013, 9, 17).toordinal(),
+                datetime.date(2013, 9, 10).toordinal(),
+                datetime.date(2013, 9, 12).toordinal(),
+            ]
+        )
+        self.assertEqual(list(self.store.starts), [36000, 34745, 28800])
+        self.assertEqual(list(self.store.ends), [37800, 64792, 57600])
+        self.assertIn(11, self.store)
+        self.assertNotIn(12, self.store)
+
+    def test_weekday(self):
+        """
+        Test weekday of date ordinal.
+        """
+        for day in range(1, 15):
+            date = datetime.date(2013, 9, day)
+            self.assertEqual(store.weekday(date.toordinal()), date.weekday())
+
+    def test_snapshot(self):
+        """
+        Test store and weekday index survive binary snapshot.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.snapshot')
+        index = {}
+        parsing.index_weekdays(index, self.data, {})
+        store.write_snapshot(path, self.store, index, {'size': 10})
+        loaded, loaded_index, metadata = store.read_snapshot(path)
+        self.assertEqual(metadata['size'], 10)
+        self.assertEqual(loaded_index, index)
+        for column in ('user_ids', 'days', 'starts', 'ends', 'offsets'):
+            self.assertEqual(
+                list(getattr(loaded, column)),
+                list(getattr(self.store, column))
+            )
+        self.assertEqual(loaded.to_data(), self.data)
+
+        with open(path, 'r+b') as snapshot:
+            snapshot.truncate(os.path.getsize(path) - 1)
+        self.assertIsNone(store.read_snapshot(path))
+        self.assertIsNone(store.read_snapshot(path + '.missing'))
+
+    def test_weekday_aggregates(self):
+        """
+        Test aggregates of days range found by binary search.
+        """
+        first = datetime.date(2013, 9, 11).toordinal()
+        last = datetime.date(2013, 9, 12).toordinal()
+        self.assertEqual(self.store.days_slice(11, first), (2, 3))
+        self.assertEqual(self.store.days_slice(11, last=first), (1, 2))
+        self.assertEqual(self.store.days_slice(11, last, first), (2, 2))
+        self.assertEqual(self.store.days_slice(10), (0, 1))
+        aggregates = self.store.weekday_aggregates(11, first, last)
+        self.assertEqual(aggregates[3], {
+            'count': 1, 'total': 28800, 'start': 28800, 'end': 57600
+        })
+        self.assertEqual(sum(day['count'] for day in aggregates), 1)
+        index = {}
+        parsing.index_weekdays(index, self.data, {})
+        self.assertEqual(self.store.weekday_aggregates(11), index[11])
+
+    def test_occupancy(self):
+        """
+        Test occupancy of slots sums intervals overlapping them.
+        """
+        days, occupancy = self.store.occupancy(3600)
+        self.assertEqual(days, [0, 2, 0, 1, 0, 0, 0])
+        self.assertEqual(
+            occupancy[1],
+            [0] * 9 + [1, 2, 1, 1, 1, 1, 1, 1, 1] + [0] * 6
+        )
+        self.assertEqual(occupancy[3], [0] * 8 + [1] * 8 + [0] * 8)
+        days, occupancy = self.store.occupancy(
+            7 * 3600, datetime.date(2013, 9, 11).toordinal()
+        )
+        self.assertEqual(days, [0, 1, 0, 1, 0, 0, 0])
+        self.assertEqual(occupancy[1], [0, 1, 0, 0])
+        self.assertEqual(occupancy[3], [0, 1, 1, 0])
+
+    def test_merge(self):
+        """
+        Test merged stores keep rows sorted and later rows replace earlier.
+        """
+        later = store.PresenceStore.from_data({
+            11: {
+                datetime.date(2013, 9, 11): {
+                    'start': datetime.time(7, 0, 0),
+                    'end': datetime.time(8, 0, 0),
+                },
+                datetime.date(2013, 9, 12): {
+                    'start': datetime.time(9, 0, 0),
+                    'end': datetime.time(10, 0, 0),
+                },
+            },
+            12: {
+                datetime.date(2013, 9, 1): {
+                    'start': datetime.time(9, 0, 0),
+                    'end': datetime.time(10, 0, 0),
+                },
+            },
+        })
+        merged, overlapping = store.PresenceStore.merge([self.store, later])
+        self.assertEqual(overlapping, set([11]))
+        self.assertEqual(list(merged.users), [10, 11, 12])
+        self.assertEqual(list(merged.offsets), [0, 1, 4, 5])
+        self.assertEqual(
+            list(merged.starts), [36000, 34745, 25200, 32400, 32400]
+        )
+        merged, overlapping = store.PresenceStore.merge([later, self.store])
+        self.assertEqual(
+            list(merged.starts), [36000, 34745, 25200, 28800, 32400]
+        )
+
+    def test_grouping(self):
+        """
+        Test store groups entries like utils functions.
+        """
+        for user_id in self.data:
+            self.assertEqual(
+                self.store.group_by_weekday(user_id),
+                utils.group_by_weekday(self.data[user_id])
+            )
+            self.assertEqual(
+                self.store.group_by_start_end(user_id),
+                utils.group_by_start_end(self.data[user_id])
+            )
+
+
 def suite():
     """
     Default test suite.
@@ -336,6 +1891,11 @@ def suite():
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceBenchmarkTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceMetricsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceProfilingTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceSchedulerTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceStoreTestCase))
     return base_suite
 
 
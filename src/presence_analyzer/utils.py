@@ -3,25 +3,54 @@
 Helper functions used in views.
 """
 
-import csv
+import calendar
+import fcntl
+import itertools
 import logging
+import mmap
 import os
 import threading
-import urllib2
 
+from binascii import hexlify, unhexlify
+from contextlib import closing
+from cStringIO import StringIO
 from datetime import datetime
-from functools import wraps
+from functools import partial, wraps
+from hashlib import md5
 from json import dumps
 from time import time
+from timeit import default_timer
+from types import GeneratorType
 
-from flask import Response
-from lxml import etree
+from flask import Response, request
 
+import compression
+import metrics
+from importer import import_presence
 from main import app
+from offsets import user_offsets
+from parsing import (
+    EMPTY_WEEK,
+    appended_offset,
+    count_rows,
+    index_weekdays,
+    parse_presence,
+    parsed_end,
+    seconds_since_midnight,
+    without_gc,
+)
+from shards import is_sharded, load_shards
+from store import PresenceStore, read_snapshot, write_snapshot
 
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
-CACHE = {}
+CACHE = {}  # function name: dict of results, see cache
+CACHE_LOCK = threading.Lock()  # taken by writers only
+USES = itertools.count()  # order of cached results use
+REFRESHING = {}  # (function name, key): refreshing thread
+SOURCES = {}  # state of loaded CSV files, see load_presence
+MAPPED = {}  # snapshots shared between processes, see get_shared_source
+LOADERS = {}  # loader locks of shared CSV files, see is_loader
 
 
 def lock(function):
@@ -37,43 +66,216 @@ def lock(function):
     return locking
 
 
-def cache(cache_time):
+def cache(cache_time, size=128):
     """
-    Cache function decorator with cache time as argument.
+    Cache function decorator with cache time and size as arguments.
+
+    Results are cached per function arguments and the least recently used
+    ones are dropped above size. Both limits can be overridden for given
+    function name in CACHE_CONFIG setting. Expired result is still
+    returned while a single background thread computes the fresh one.
+
+    Cached results are read without locking. Only computing of results
+    is serialized, so concurrent misses compute the result once.
+
+    Decorated function gets refresh attribute, which replaces cached
+    result of given arguments with a fresh one.
     """
     def _cache(function):
+        name = function.__name__
+        loading = threading.Lock()
+
+        def refresh(*args, **kwargs):
+            """
+            Computes fresh result and replaces the cached one with it.
+            """
+            with loading:
+                data = function(*args, **kwargs)
+                store_cache(
+                    name, (args, tuple(sorted(kwargs.items()))), data,
+                    app.config['CACHE_CONFIG'].get(name, {}).get('size', size)
+                )
+            return data
+
+        @wraps(function)
         def __cache(*args, **kwargs):
-            name = function.__name__
-            if name in CACHE:
-                if CACHE[name]['time'] < time() + cache_time:
-                    return CACHE[name]['data']
-            CACHE[name] = {
-                'data': function(*args, **kwargs),
-                'time': time()
-            }
-            return CACHE[name]['data']
+            settings = app.config['CACHE_CONFIG'].get(name, {})
+            key = (args, tuple(sorted(kwargs.items())))
+            entry = CACHE.get(name, {}).get(key)
+            if entry is None:
+                with loading:
+                    entry = CACHE.get(name, {}).get(key)
+                    if entry is None:
+                        metrics.increment(
+                            'presence_cache_requests_total',
+                            function=name, result='miss'
+                        )
+                        data = function(*args, **kwargs)
+                        store_cache(
+                            name, key, data, settings.get('size', size)
+                        )
+                        return data
+            entry['used'] = next(USES)
+            if time() - entry['time'] >= settings.get('time', cache_time):
+                metrics.increment(
+                    'presence_cache_requests_total',
+                    function=name, result='stale'
+                )
+                refresh_cache(name, key, refresh, args, kwargs)
+            else:
+                metrics.increment(
+                    'presence_cache_requests_total',
+                    function=name, result='hit'
+                )
+            return entry['data']
+
+        __cache.refresh = refresh
         return __cache
     return _cache
 
 
-def jsonify(function):
+def store_cache(name, key, data, size):
+    """
+    Stores function result in CACHE, dropping least recently used ones.
+
+    Results of the function are copied and replaced as a whole, so they
+    are never changed while being read.
     """
-    Creates a response with the JSON representation of wrapped function result.
+    with CACHE_LOCK:
+        entries = dict(CACHE.get(name, {}))
+        entries[key] = {'data': data, 'time': time(), 'used': next(USES)}
+        while len(entries) > size:
+            del entries[min(entries, key=lambda key: entries[key]['used'])]
+        CACHE[name] = entries
+
+
+def refresh_cache(name, key, refresh, args, kwargs):
     """
-    @wraps(function)
-    def inner(*args, **kwargs):
+    Starts background refresh of cached result unless one is running.
+    """
+    def refreshing():
         """
-        This docstring will be overridden by @wraps decorator.
+        Computes fresh result and stores it in cache.
         """
-        return Response(
-            dumps(function(*args, **kwargs)),
-            mimetype='application/json'
-        )
-    return inner
+        try:
+            refresh(*args, **kwargs)
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Refreshing %s failed', name)
+        finally:
+            with CACHE_LOCK:
+                del REFRESHING[(name, key)]
+
+    with CACHE_LOCK:
+        if (name, key) in REFRESHING:
+            return
+        thread = threading.Thread(target=refreshing, name='refresh-' + name)
+        thread.daemon = True
+        REFRESHING[(name, key)] = thread
+        thread.start()
+
+
+def jsonify(*sources, **options):
+    """
+    JSON response decorator with data sources of the view as arguments.
+
+    Creates a response with the JSON representation of wrapped function
+    result. Generator results are encoded as JSON list and streamed in
+    chunks while being generated, other results are encoded at once.
+
+    Response carries ETag and Last-Modified of given sources, 'csv' for
+    presence data and 'xml' for users, conditional requests for unchanged
+    data get empty 304 response without calling the function. Validators
+    are skipped when a source can't be read. Functions given as query
+    option parse query arguments of the view before, so invalid ones get
+    400 response rather than 304.
+    """
+    def _jsonify(function):
+        @wraps(function)
+        def inner(*args, **kwargs):
+            """
+            This docstring will be overridden by @wraps decorator.
+            """
+            for parse in options.get('query', ()):
+                parse()
+            version = data_version(sources)
+            if version is not None and is_not_modified(*version):
+                response = Response(status=304)
+            else:
+                result = function(*args, **kwargs)
+                if isinstance(result, GeneratorType):
+                    result = stream_json(
+                        result, app.config['JSON_CHUNK_SIZE']
+                    )
+                else:
+                    result = dumps(result)
+                response = Response(result, mimetype='application/json')
+            if version is not None:
+                response.set_etag(version[0])
+                response.last_modified = version[1]
+            return response
+        return inner
+    return _jsonify
+
+
+def stream_json(items, chunk_size):
+    """
+    Encodes items as JSON list in chunks of about chunk_size bytes.
+
+    Output is the same as dumps(list(items)) gives.
+    """
+    chunk = ['[']
+    size = 1
+    separator = ''
+    for item in items:
+        encoded = separator + dumps(item)
+        chunk.append(encoded)
+        size += len(encoded)
+        separator = ', '
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(']')
+    yield ''.join(chunk)
+
+
+def is_not_modified(etag, last_modified):
+    """
+    Checks conditional headers of current request against data version.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since:
+        return request.if_modified_since >= last_modified
+    return False
+
+
+def data_version(sources):
+    """
+    Returns (etag, last_modified) identifying given sources of data, see
+    jsonify, or None when a source file can't be read.
+
+    Only the sources a view depends on are checked, so views of presence
+    data don't need XML file and users view doesn't load presence data.
+    """
+    versions = []
+    try:
+        if 'csv' in sources:
+            versions.append(source_version())
+        if 'xml' in sources:
+            xml = os.stat(app.config['XML_DATA'])
+            versions.append(
+                ((xml.st_dev, xml.st_ino), xml.st_size, xml.st_mtime)
+            )
+    except (IOError, OSError):
+        log.debug('Cannot check version of %s', sources, exc_info=True)
+        return None
+    last_modified = datetime.utcfromtimestamp(
+        int(max(mtime for inode, size, mtime in versions))
+    )
+    return md5(repr(versions)).hexdigest(), last_modified
 
 
-@lock
-@cache(600)
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
@@ -92,56 +294,583 @@ def get_data():
         }
     }
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
-    return data
-
-
-def xml_data_parser():
-    """
-    Parse data from xml file.
-    """
-    with open(app.config['XML_DATA'], 'r') as users:
-        tree = etree.parse(users)
-        users = tree.find('users')
-        server = tree.find('server')
-        host = server.find('host').text
-        protocol = server.find('protocol').text
-        data = {
-            int(user.get('id')): {
-                'avatar': '{protocol}://{host}{user}'.format(
-                    protocol=protocol,
-                    host=host,
-                    user=user.find('avatar').text
-                ),
-                'name': user.find('name').text
-            }
-            for user in users.findall('user')
+    return source_data(get_source())
+
+
+def get_weekday_index():
+    """
+    Returns per-user weekday aggregates of presence data.
+
+    It creates structure like this (one dict for every day in week):
+    index = {
+        'user_id': [
+            {'count': 2, 'total': 54000, 'start': 63000, 'end': 117000},
+            {'count': 0, 'total': 0, 'start': 0, 'end': 0},
+            ...
+        ]
+    }
+    where total is sum of presence intervals, start and end are sums of
+    seconds since midnight.
+    """
+    return get_source()['index']
+
+
+def get_source():
+    """
+    Returns presence data loaded from DATA_CSV with its weekday index.
+
+    With DATA_SHARED enabled it comes from snapshot shared between
+    processes, see get_shared_source.
+    """
+    if is_shared(app.config['DATA_CSV']):
+        return get_shared_source(app.config['DATA_CSV'])
+    return load_source()
+
+
+@cache(600, size=1)
+def load_source():
+    """
+    Returns presence data loaded from DATA_CSV by this process.
+
+    DATA_CSV is either a single file or shards given as directory of CSV
+    files or glob pattern, see load_shards.
+    """
+    path = app.config['DATA_CSV']
+    if is_sharded(path):
+        source = SOURCES[path] = load_shards(path, SOURCES.get(path))
+        return source
+    return load_presence(path)
+
+
+def get_shared_source(path):
+    """
+    Returns presence data shared between processes.
+
+    Process holding loader lock of the CSV file loads it like in single
+    process mode and publishes every new version as snapshot. All
+    processes, loader included, read the published snapshot through
+    shared memory-map, so there is one copy of it in memory and every
+    process switches to new version as soon as it is renamed into place.
+    Until the first snapshot is published processes load data on their
+    own and drop it once they read the snapshot.
+    """
+    loader = is_loader(path)
+    if loader:
+        publish_source(path, load_source())
+    try:
+        stat = os.stat(snapshot_path(path))
+    except OSError:
+        return load_source()
+    identity = (stat.st_dev, stat.st_ino, stat.st_mtime)
+    mapped = MAPPED.get(path)
+    if mapped is None or mapped['identity'] != identity:
+        source = load_snapshot(path)
+        if source is None:
+            return load_source()
+        mapped = MAPPED[path] = {'identity': identity, 'source': source}
+        if not loader:
+            with CACHE_LOCK:
+                CACHE.pop('load_source', None)
+            SOURCES.pop(path, None)
+    return mapped['source']
+
+
+def is_shared(path):
+    """
+    Checks if presence data of DATA_CSV file is shared between processes
+    (DATA_SHARED is enabled), see get_shared_source.
+
+    Shards are not shared and neither is file whose loader lock can't be
+    opened, like in read-only directory, every process loads it then.
+    """
+    if not app.config['DATA_SHARED'] or is_sharded(path):
+        return False
+    return get_loader(path)['lockfile'] is not None
+
+
+def get_loader(path):
+    """
+    Returns loader lock of shared CSV file, see is_loader.
+
+    Its lockfile is None when the lock file can't be opened.
+    """
+    loader = LOADERS.get(path)
+    if loader is None:
+        try:
+            lockfile = open(snapshot_path(path) + '.lock', 'a')
+        except IOError:
+            log.warning(
+                'Cannot open loader lock of %s, data is not shared', path,
+                exc_info=True
+            )
+            lockfile = None
+        loader = LOADERS.setdefault(
+            path, {'lockfile': lockfile, 'locked': False}
+        )
+    return loader
+
+
+def is_loader(path):
+    """
+    Checks if this process is the loader of shared data of CSV file.
+
+    The first process which locks the lock file next to the CSV becomes
+    the loader until it exits.
+    """
+    loader = get_loader(path)
+    if not loader['locked']:
+        try:
+            fcntl.flock(loader['lockfile'], fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return False
+        loader['locked'] = True
+    return True
+
+
+def publish_source(path, source):
+    """
+    Writes snapshot of source unless it was written or read from one.
+
+    Source is checked before taking the lock too, so the loader does not
+    lock on every get_source once its snapshot is written.
+    """
+    if not source['snapshot']:
+        save_published(path, source)
+
+
+@lock
+def save_published(path, source):
+    """
+    Writes snapshot of source once, even when published concurrently.
+    """
+    if not source['snapshot']:
+        save_snapshot(path, source)
+
+
+@without_gc
+def load_presence(path):
+    """
+    Parses presence CSV file, reusing results of the previous load.
+
+    As long as the file keeps its identity (inode) and only grows, just
+    the bytes appended since the last load are parsed and merged into
+    a copy of previously loaded compact store and weekday index, data is
+    then created from the store only when needed (see source_data).
+    Truncated, rewritten or replaced file is parsed from scratch.
+
+    When DATA_SNAPSHOT is enabled, the first load in a process starts
+    from binary snapshot of previous load (see load_snapshot). Every full
+    parse writes a new one and so does incremental one once more than
+    DATA_SNAPSHOT_THRESHOLD bytes were appended since the last snapshot.
+
+    Compressed file (see compression.detect) is decompressed while it is
+    parsed and parsed from scratch whenever it changes.
+
+    Returns a new source dict with 'data', 'store' and 'index' keys on
+    every change, previously returned ones are never modified. Store is
+    built here rather than by its first query, so requests never wait
+    for it.
+    """
+    stat = os.stat(path)
+    previous = SOURCES.get(path)
+    if previous is None and app.config['DATA_SNAPSHOT']:
+        previous = load_snapshot(path)
+    with open(path, 'rb') as csvfile:
+        compressed = compression.detect(csvfile, path)
+        offset = appended_offset(csvfile, compressed, stat, previous)
+        if offset is None:
+            SOURCES[path] = previous
+            return previous
+        if not offset:
+            previous = None
+        csvfile.seek(offset)
+        started = default_timer()
+        appended, malformed = parse_presence(
+            compression.decompressed(csvfile, compressed),
+            app.config['CSV_CHUNK_SIZE']
+        )
+        metrics.observe(
+            'presence_parse_seconds', default_timer() - started,
+            mode='full' if previous is None else 'append'
+        )
+        size, offset, tail = parsed_end(csvfile, compressed, stat, offset)
+    data, index, store = merge_presence(previous, appended)
+    count_rows(
+        sum(len(items) for items in appended.itervalues()), malformed, path
+    )
+    source = {
+        'data': data,
+        'index': index,
+        'store': store,
+        'snapshot': False,
+        'inode': (stat.st_dev, stat.st_ino),
+        'size': size,
+        'mtime': stat.st_mtime,
+        'offset': offset,
+        'tail': tail,
+        'snapshot_offset': previous['snapshot_offset'] if previous else 0,
+    }
+    if app.config['DATA_SNAPSHOT'] and (
+            previous is None or offset - source['snapshot_offset'] >
+            app.config['DATA_SNAPSHOT_THRESHOLD']):
+        save_snapshot(path, source)
+    SOURCES[path] = source
+    return source
+
+
+def merge_presence(previous, appended):
+    """
+    Returns (data, index, store) of appended presence data merged into
+    previous source, or of appended data alone when previous is None.
+
+    Appended rows are merged into copy of the store of previous source,
+    so its data is not needed. Weekday aggregates of appended rows are
+    added to the index, users with replaced rows are aggregated again.
+    """
+    store = PresenceStore.from_data(appended)
+    if previous is None:
+        index = {}
+        index_weekdays(index, appended, {})
+        return appended, index, store
+    index = dict(previous['index'])
+    index_weekdays(index, appended, {})
+    store, overlapping = PresenceStore.merge([previous['store'], store])
+    for user_id in overlapping:
+        index[user_id] = store.weekday_aggregates(user_id)
+    return None, index, store
+
+
+def source_data(source):
+    """
+    Returns data of source, creating it from compact store if needed.
+    """
+    if source['data'] is None:
+        source['data'] = source['store'].to_data()
+    return source['data']
+
+
+def snapshot_path(path):
+    """
+    Returns path of binary snapshot of given CSV file.
+    """
+    return path + '.snapshot'
+
+
+def save_snapshot(path, source):
+    """
+    Writes binary snapshot of source loaded from given CSV file.
+    """
+    metadata = {
+        name: source[name] for name in ('inode', 'size', 'mtime', 'offset')
+    }
+    metadata['tail'] = hexlify(source['tail'])
+    try:
+        write_snapshot(
+            snapshot_path(path), source['store'], source['index'], metadata
+        )
+    except (IOError, OSError):
+        log.warning('Cannot write snapshot of %s', path, exc_info=True)
+    else:
+        source['snapshot'] = True
+        source['snapshot_offset'] = source['offset']
+
+
+def load_snapshot(path):
+    """
+    Returns source read from binary snapshot of given CSV file.
+
+    Data of source is created from its compact store only when needed,
+    weekday index is read directly. Returns None without snapshot.
+    """
+    snapshot = read_snapshot(snapshot_path(path))
+    if snapshot is None:
+        return None
+    store, index, metadata = snapshot
+    source = {
+        name: metadata[name] for name in ('size', 'mtime', 'offset')
+    }
+    source.update(
+        data=None,
+        index=index,
+        store=store,
+        snapshot=True,
+        inode=tuple(metadata['inode']),
+        tail=unhexlify(metadata['tail']),
+        snapshot_offset=metadata['offset'],
+    )
+    return source
+
+
+def get_store():
+    """
+    Returns presence data from get_data as a compact PresenceStore.
+
+    Store is created together with every loaded version of data.
+    """
+    return get_source()['store']
+
+
+def get_user_weekdays(user_id, first=None, last=None):
+    """
+    Returns weekday aggregates of user like get_weekday_index, limited to
+    dates from first to last (inclusive) when given.
+
+    Limited aggregates are computed from rows of the range only, found
+    by binary search in the store. In DATA_LAZY mode rows of the user are
+    loaded on their own, see load_user, with sqlite DATA_ENGINE they are
+    aggregated by SQL query. Returns None for unknown user.
+    """
+    path = app.config['DATA_CSV']
+    if not is_database(path) and is_lazy(path):
+        store = load_user(source_version(), user_id)
+        if store is None:
+            return None
+        return store_weekdays(store, user_id, first, last)
+    return get_weekdays_reader(first, last)(user_id)
+
+
+def get_weekdays_reader(first=None, last=None):
+    """
+    Returns function giving weekday aggregates of user like
+    get_user_weekdays.
+
+    Data is looked up once, so aggregates of many users read with the
+    function come from the same version of data, even when it is
+    reloaded meanwhile. Like in group_stats users are not loaded one by
+    one in DATA_LAZY mode, so batches don't evict load_user cache.
+    """
+    if is_database(app.config['DATA_CSV']):
+        store = get_database()
+    else:
+        source = get_source()
+        if first is None and last is None:
+            return source['index'].get
+        store = source['store']
+    return partial(store_weekdays, store, first=first, last=last)
+
+
+def store_weekdays(store, user_id, first, last):
+    """
+    Returns weekday aggregates of user in store on dates from first to
+    last, None for unknown user.
+    """
+    if user_id not in store:
+        return None
+    return store.weekday_aggregates(
+        user_id,
+        first and first.toordinal(),
+        last and last.toordinal(),
+    )
+
+
+def aggregate_stats(user_ids=None, first=None, last=None):
+    """
+    Returns weekday statistics of given users together, of all users when
+    user_ids is None, limited to dates from first to last when given.
+
+    Result is cached per loaded version of data, see group_stats.
+    """
+    if user_ids is not None:
+        user_ids = tuple(sorted(set(user_ids)))
+    return group_stats(source_version(), user_ids, first, last)
+
+
+@cache(600, size=64)
+def group_stats(version, user_ids, first, last):
+    """
+    Computes aggregate_stats of loaded data version.
+
+    Without date range it sums weekday index of users, otherwise rows of
+    the range of every user, found by binary search in the store. With
+    sqlite DATA_ENGINE rows are summed by SQL query. Unknown users are
+    skipped.
+
+    Users are not loaded one by one in DATA_LAZY mode, all of them are
+    summed from data loaded as a whole, so load_user cache is kept for
+    single user views.
+    """
+    # pylint: disable=unused-argument
+    if is_database(app.config['DATA_CSV']):
+        users, totals = get_database().group_aggregates(
+            user_ids, first and first.toordinal(), last and last.toordinal()
+        )
+        return group_result(users, totals)
+    index = get_weekday_index()
+    store = None if first is None and last is None else get_store()
+    if user_ids is None:
+        user_ids = sorted(index)
+    user_ids = [user_id for user_id in user_ids if user_id in index]
+    totals = [dict(aggregates) for aggregates in EMPTY_WEEK]
+    for user_id in user_ids:
+        if store is None:
+            weekdays = index[user_id]
+        else:
+            weekdays = store.weekday_aggregates(
+                user_id, first and first.toordinal(), last and last.toordinal()
+            )
+        for total, aggregates in zip(totals, weekdays):
+            total['count'] += aggregates['count']
+            total['total'] += aggregates['total']
+            total['start'] += aggregates['start']
+            total['end'] += aggregates['end']
+    return group_result(len(user_ids), totals)
+
+
+def group_result(users, totals):
+    """
+    Returns group_stats of given number of users and their aggregates.
+    """
+    return {
+        'users': users,
+        'mean_time_weekday': mean_time_weekday(totals),
+        'presence_weekday': presence_weekday(totals),
+        'presence_start_end': presence_start_end(totals),
+    }
+
+
+def occupancy(slot, first=None, last=None):
+    """
+    Returns mean number of users present in every slot of given width in
+    seconds, by weekday, on dates from first to last when given.
+
+    It creates structure like this (one dict for every day in week):
+    occupancy = [
+        {'weekday': 'Mon', 'days': 52, 'occupancy': [0, 0, ..., 1.5, ...]},
+        ...
+    ]
+    where days is number of dates with presence the mean is taken over.
+    Result is cached per loaded version of data.
+    """
+    return weekday_occupancy(source_version(), slot, first, last)
+
+
+@cache(600, size=64)
+def weekday_occupancy(version, slot, first, last):
+    """
+    Computes occupancy of loaded data version with the store or with SQL
+    queries of sqlite DATA_ENGINE.
+    """
+    # pylint: disable=unused-argument
+    if is_database(app.config['DATA_CSV']):
+        store = get_database()
+    else:
+        store = get_store()
+    days, counts = store.occupancy(
+        slot,
+        first and first.toordinal(),
+        last and last.toordinal(),
+    )
+    return [
+        {
+            'weekday': calendar.day_abbr[weekday],
+            'days': days[weekday],
+            'occupancy': [
+                average(count, days[weekday]) for count in counts[weekday]
+            ],
         }
-    return data
+        for weekday in range(7)
+    ]
+
+
+def source_version():
+    """
+    Returns identity of loaded version of presence data.
+
+    In DATA_LAZY mode it is the identity of the CSV file itself, so it
+    does not load all data. With sqlite DATA_ENGINE it is the identity
+    of the file imported to database.
+    """
+    path = app.config['DATA_CSV']
+    if is_database(path):
+        source = load_database()
+    elif is_lazy(path):
+        stat = os.stat(path)
+        return (stat.st_dev, stat.st_ino), stat.st_size, stat.st_mtime
+    else:
+        source = get_source()
+    return source['inode'], source['size'], source['mtime']
+
+
+def is_lazy(path):
+    """
+    Checks if users of DATA_CSV file are loaded one by one on demand.
+
+    Compressed files can't be read at offsets and are always loaded as
+    a whole.
+    """
+    if not app.config['DATA_LAZY'] or is_sharded(path):
+        return False
+    with open(path, 'rb') as csvfile:
+        return compression.detect(csvfile, path) is None
+
+
+def get_user_ids():
+    """
+    Returns sorted ids of users with presence data.
+    """
+    path = app.config['DATA_CSV']
+    if is_database(path):
+        return get_database().user_ids()
+    if is_lazy(path):
+        return sorted(user_offsets(path))
+    return sorted(get_weekday_index())
+
+
+@cache(600, size=1024)
+def load_user(version, user_id):
+    """
+    Returns PresenceStore with rows of single user of DATA_CSV file or
+    None for unknown user.
+
+    Only byte ranges of the user found by user_offsets are read from
+    memory-mapped file and parsed. Loaded users are cached per version
+    of the file and the least recently used ones are dropped above
+    CACHE_CONFIG size of load_user, so memory is proportional to the
+    number of active users rather than to all data.
+    """
+    # pylint: disable=unused-argument
+    path = app.config['DATA_CSV']
+    ranges = user_offsets(path).get(user_id)
+    if not ranges:
+        return None
+    with open(path, 'rb') as csvfile:
+        mapped = mmap.mmap(csvfile.fileno(), 0, access=mmap.ACCESS_READ)
+    with closing(mapped):
+        rows = StringIO(''.join(
+            mapped[start:end] for start, end in zip(ranges[::2], ranges[1::2])
+        ))
+    data, malformed = parse_presence(rows, app.config['CSV_CHUNK_SIZE'])
+    count_rows(
+        sum(len(items) for items in data.itervalues()), malformed,
+        'user {}'.format(user_id)
+    )
+    if user_id not in data:
+        return None
+    return PresenceStore.from_data({user_id: data[user_id]})
+
+
+def is_database(path):
+    """
+    Checks if presence data of DATA_CSV file is queried from SQLite
+    database (DATA_ENGINE is sqlite).
+    """
+    return app.config['DATA_ENGINE'] == 'sqlite' and not is_sharded(path)
 
 
-def xml_update_data():
+def get_database():
     """
-    Update data from xml file.
+    Returns PresenceDatabase with presence data of DATA_CSV.
     """
-    with open(app.config['XML_DATA'], 'w') as file:
-        response = urllib2.urlopen(app.config['UPDATE_XML_DATA'])
-        html = response.read()
-        file.write(html)
+    return load_database()['database']
+
+
+@cache(600, size=1)
+def load_database():
+    """
+    Returns source of DATA_CSV imported to SQLite database, see
+    import_presence.
+    """
+    return import_presence(app.config['DATA_CSV'])
 
 
 def group_by_weekday(items):
@@ -173,11 +902,61 @@ def group_by_start_end(items):
     return result
 
 
-def seconds_since_midnight(time):
+def mean_time_weekday(weekdays):
+    """
+    Returns mean presence time per weekday from weekday index entry.
+    """
+    return [
+        (calendar.day_abbr[weekday], average(day['total'], day['count']))
+        for weekday, day in enumerate(weekdays)
+    ]
+
+
+def presence_weekday(weekdays):
+    """
+    Returns total presence time per weekday from weekday index entry.
+    """
+    result = [
+        (calendar.day_abbr[weekday], day['total'])
+        for weekday, day in enumerate(weekdays)
+    ]
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+def presence_start_end(weekdays):
     """
-    Calculates amount of seconds since midnight.
+    Returns mean start and end time per weekday from weekday index entry.
     """
-    return time.hour * 3600 + time.minute * 60 + time.second
+    return [
+        (
+            calendar.day_abbr[weekday],
+            average(day['start'], day['count']),
+            average(day['end'], day['count']),
+        )
+        for weekday, day in enumerate(weekdays)
+    ]
+
+
+def weekday_stats(user_id, weekdays):
+    """
+    Returns all weekday statistics of user from weekday index entry.
+
+    Statistics are empty for unknown user (weekdays is None).
+    """
+    stats = {
+        'user_id': user_id,
+        'mean_time_weekday': [],
+        'presence_weekday': [],
+        'presence_start_end': [],
+    }
+    if weekdays is None:
+        log.debug('User %s not found!', user_id)
+    else:
+        stats['mean_time_weekday'] = mean_time_weekday(weekdays)
+        stats['presence_weekday'] = presence_weekday(weekdays)
+        stats['presence_start_end'] = presence_start_end(weekdays)
+    return stats
 
 
 def interval(start, end):
@@ -193,3 +972,10 @@ def mean(items):
     """
     return float(sum(items)) / len(items) if len(items) > 0 else 0
 
+
+def average(total, count):
+    """
+    Calculates arithmetic mean from sum and count. Returns zero for no items.
+    """
+    return float(total) / count if count > 0 else 0
+
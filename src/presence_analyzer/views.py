@@ -3,29 +3,91 @@
 Defines views.
 """
 
-import calendar
 import datetime
 import logging
+from timeit import default_timer
 
-from flask import abort, make_response, redirect, render_template
+from flask import (
+    Response,
+    abort,
+    g,
+    make_response,
+    redirect,
+    render_template,
+    request
+)
 from flask.ext.mako import render_template
 from jinja2.exceptions import TemplateNotFound
 
+import metrics
 from main import app
+from parsing import parse_date
 from utils import (
-    get_data,
-    group_by_start_end,
-    group_by_weekday,
+    aggregate_stats,
+    get_user_ids,
+    get_user_weekdays,
+    get_weekdays_reader,
     jsonify,
-    mean,
-    seconds_since_midnight,
-    xml_data_parser
+    mean_time_weekday,
+    occupancy,
+    presence_start_end,
+    presence_weekday,
+    weekday_stats
 )
+from xmldata import xml_data_parser
 
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
+@app.before_request
+def start_timer():
+    """
+    Remembers when handling of request started.
+    """
+    g.started = default_timer()
+
+
+@app.after_request
+def remember_status(response):
+    """
+    Remembers status code of response for record_request.
+    """
+    g.status = response.status_code
+    return response
+
+
+@app.teardown_request
+def record_request(error):
+    """
+    Records time of handling request and its status in metrics.
+
+    Requests are recorded when their context is torn down, so failed
+    requests, whose error responses skip after_request hooks, are
+    recorded too with status 500. Time of streamed responses does not
+    include streaming.
+    """
+    endpoint = request.endpoint or 'unknown'
+    status = 500 if error is not None else getattr(g, 'status', 500)
+    metrics.observe(
+        'presence_request_seconds', default_timer() - g.started,
+        endpoint=endpoint
+    )
+    metrics.increment(
+        'presence_requests_total', endpoint=endpoint, status=status
+    )
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Returns metrics in Prometheus text format.
+    """
+    return Response(
+        metrics.render(), mimetype='text/plain; version=0.0.4'
+    )
+
+
 @app.route('/<string:templates_name>/', methods=['GET'])
 def render_templates(templates_name):
     """
@@ -48,20 +110,19 @@ def mainpage():
 
 
 @app.route('/api/v1/users', methods=['GET'])
-@jsonify
+@jsonify('csv')
 def users_view():
     """
     Users listing for dropdown.
     """
-    data = get_data()
     return [
         {'user_id': i, 'name': 'User {0}'.format(str(i))}
-        for i in data.keys()
+        for i in get_user_ids()
     ]
 
 
 @app.route('/api/v2/users', methods=['GET'])
-@jsonify
+@jsonify('xml')
 def xml_data_view():
     """
     Loading data from xml_data_parser for users.
@@ -76,63 +137,144 @@ def xml_data_view():
     ]
 
 
+def requested_user_ids():
+    """
+    Returns user ids of comma separated user_ids query parameter or None
+    when it is missing or equal to "all".
+
+    Aborts with 400 on invalid user id.
+    """
+    user_ids = request.args.get('user_ids', 'all')
+    if user_ids == 'all':
+        return None
+    try:
+        return [int(user_id) for user_id in user_ids.split(',')]
+    except ValueError:
+        abort(400)
+
+
+def date_range():
+    """
+    Returns dates of from and to query parameters, None when not given.
+
+    Aborts with 400 on invalid date.
+    """
+    try:
+        return [
+            parse_date(request.args[name]) if name in request.args else None
+            for name in ('from', 'to')
+        ]
+    except ValueError:
+        abort(400)
+
+
+def requested_slot():
+    """
+    Returns slot width in minutes of slot query parameter, 15 by default.
+
+    Aborts with 400 on invalid width.
+    """
+    try:
+        slot = int(request.args.get('slot', 15))
+    except ValueError:
+        abort(400)
+    if not 0 < slot <= 24 * 60:
+        abort(400)
+    return slot
+
+
 @app.route('/api/v2/mean_time_weekday/<int:user_id>', methods=['GET'])
-@jsonify
+@jsonify('csv', query=[date_range])
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
+
+    Optional from and to query parameters (YYYY-MM-DD, inclusive) limit
+    presence to given dates, like in the other per-user views.
     """
-    data = get_data()
-    if user_id not in data:
+    weekdays = get_user_weekdays(user_id, *date_range())
+    if weekdays is None:
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-    return result
+    return mean_time_weekday(weekdays)
 
 
 @app.route('/api/v2/presence_weekday/<int:user_id>', methods=['GET'])
-@jsonify
+@jsonify('csv', query=[date_range])
 def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    weekdays = get_user_weekdays(user_id, *date_range())
+    if weekdays is None:
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    return presence_weekday(weekdays)
 
 
 @app.route('/api/v2/presence_start_end/<int:user_id>', methods=['GET'])
-@jsonify
+@jsonify('csv', query=[date_range])
 def presence_start_end_view(user_id):
     """
     Returns start and end time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    weekdays = get_user_weekdays(user_id, *date_range())
+    if weekdays is None:
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_weekday(data[user_id])
-    start_end_weekdays = group_by_start_end(data[user_id])
-    result = [(
-        calendar.day_abbr[weekday],
-        mean(start_end_weekdays[weekday]['start']),
-        mean(start_end_weekdays[weekday]['end']))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-    return result
+    return presence_start_end(weekdays)
+
+
+@app.route('/api/v2/weekday_stats', methods=['GET'])
+@jsonify('csv', query=[date_range, requested_user_ids])
+def weekday_stats_view():
+    """
+    Returns weekday statistics of many users at once.
+
+    Users are given as comma separated user_ids query parameter, all of
+    them are returned when it is missing or equal to "all". Statistics
+    of unknown users are empty, like in single user views, and from and
+    to parameters limit dates like there too. Response is streamed while
+    statistics are computed, all of them from the same version of data.
+    """
+    first, last = date_range()
+    user_ids = requested_user_ids()
+    if user_ids is None:
+        user_ids = get_user_ids()
+    weekdays = get_weekdays_reader(first, last)
+
+    return (
+        weekday_stats(user_id, weekdays(user_id))
+        for user_id in user_ids
+    )
+
+
+@app.route('/api/v2/aggregate_stats', methods=['GET'])
+@jsonify('csv', query=[date_range, requested_user_ids])
+def aggregate_stats_view():
+    """
+    Returns weekday statistics of many users together.
+
+    Users and dates are limited by user_ids, from and to parameters like
+    in weekday_stats_view, by default statistics cover the whole company.
+    Number of users found is returned with statistics.
+    """
+    first, last = date_range()
+    return aggregate_stats(requested_user_ids(), first, last)
+
+
+@app.route('/api/v2/occupancy', methods=['GET'])
+@jsonify('csv', query=[date_range, requested_slot])
+def occupancy_view():
+    """
+    Returns mean number of users present in time slots by weekday.
+
+    Slot width is given in minutes by slot query parameter (15 by
+    default), from and to parameters limit dates like in other views.
+    """
+    first, last = date_range()
+    return occupancy(requested_slot() * 60, first, last)
 
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Users data read from XML file.
+"""
+
+import logging
+import os
+import shutil
+import urllib2
+from contextlib import closing
+from json import dump, load
+
+from lxml import etree
+
+from files import atomic_write
+from main import app
+
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+USERS = {}  # parsed XML files, see xml_data_parser
+
+
+def xml_data_parser():
+    """
+    Parse data from xml file.
+
+    Parsed users are kept in memory until mtime or size of the file
+    changes.
+    """
+    path = app.config['XML_DATA']
+    stat = os.stat(path)
+    version = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+    parsed = USERS.get(path)
+    if parsed is None or parsed['version'] != version:
+        parsed = USERS[path] = {'version': version, 'data': parse_users(path)}
+    return parsed['data']
+
+
+def parse_users(path):
+    """
+    Parses users from xml file.
+
+    File is parsed incrementally and processed elements are dropped, so
+    memory usage does not grow with the size of the file.
+    """
+    users = {}
+    server = {}
+    for _, element in etree.iterparse(path):
+        if element.tag == 'user':
+            users[int(element.get('id'))] = {
+                'avatar': element.findtext('avatar'),
+                'name': element.findtext('name'),
+            }
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        elif element.tag in ('host', 'protocol') and \
+                element.getparent().tag == 'server':
+            server[element.tag] = element.text
+    for user in users.itervalues():
+        user['avatar'] = '{protocol}://{host}{user}'.format(
+            protocol=server['protocol'],
+            host=server['host'],
+            user=user['avatar']
+        )
+    return users
+
+
+def xml_update_data():
+    """
+    Update data from xml file.
+
+    Download is conditional on validators of the previous one, stored
+    next to XML_DATA, and streamed to a temporary file which replaces
+    XML_DATA only when the download is complete. Returns False when
+    data was not modified.
+    """
+    path = app.config['XML_DATA']
+    validators_path = path + '.validators'
+    try:
+        with open(validators_path) as validators_file:
+            validators = load(validators_file)
+    except (IOError, ValueError):
+        validators = {}
+    update = urllib2.Request(app.config['UPDATE_XML_DATA'])
+    if validators.get('etag'):
+        update.add_header('If-None-Match', validators['etag'])
+    if validators.get('last_modified'):
+        update.add_header('If-Modified-Since', validators['last_modified'])
+    try:
+        response = urllib2.urlopen(
+            update, timeout=app.config['UPDATE_XML_TIMEOUT']
+        )
+    except urllib2.HTTPError as error:
+        if error.code == 304:
+            log.info('%s not modified', path)
+            return False
+        raise
+
+    with closing(response):
+        with atomic_write(path) as xmlfile:
+            shutil.copyfileobj(
+                response, xmlfile, app.config['UPDATE_XML_CHUNK_SIZE']
+            )
+            size = xmlfile.tell()
+            length = response.info().getheader('Content-Length')
+            if length is not None and int(length) != size:
+                raise IOError(
+                    'Incomplete download, {} of {} bytes'.format(size, length)
+                )
+        validators = {
+            'etag': response.info().getheader('ETag'),
+            'last_modified': response.info().getheader('Last-Modified'),
+        }
+    with atomic_write(validators_path) as validators_file:
+        dump(validators, validators_file)
+    log.info('%s updated', path)
+    return True